@@ -15,26 +15,603 @@ import threading
 from hashlib import md5
 import unicodedata
 import datetime
+import calendar
 import itertools
+import bisect
+import array
+import heapq
 import inspect
 import re
+import math
+import random
+import json
+import concurrent.futures
+import asyncio
+import io
+import urllib.parse
+import http.client
+import gzip
+import zlib
 
 import sys
 import collections
+import collections.abc
 import copy
 import logging
 import threading
 
+class HttpFetcher(object):
+    """This Class downloads the pages from seloger.com,
+    it keeps the connections open (one by worker thread),
+    asks for compressed pages, revalidates the pages already in its
+    on disk cache (ETag/Last-Modified) and retries on transient errors
+    """
+
+    def __init__(self, log, filename='cache.seloger', max_entries=1000,
+            ttl=86400, timeout=30, retries=3, backoff=1.0):
+        self.log = log
+        self.filename = filename
+        #the maximum number of pages in the cache
+        #(the least recently used are removed first)
+        self.max_entries = max_entries
+        #the maximum age (in seconds) of a page in the cache
+        self.ttl = ttl
+        #the timeout (in seconds) of each request
+        self.timeout = timeout
+        #the number of retries on transient errors, and the first wait
+        #between two tries (doubled each time)
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+        self.cache_lock = threading.Lock()
+        self.cache = None
+
+    def _getCache(self):
+        """this function returns the cache database connexion,
+        if the cache doesn't exist, it creates it.
+        no argument.
+        """
+        try:
+            import sqlite3
+        except ImportError:
+            raise Exception('You need to have sqlite3 installed to ' \
+                                   'use SeLoger.')
+        if self.cache is not None:
+            return self.cache
+        cache = sqlite3.connect(self.filename, check_same_thread = False)
+        #url: the url of the page
+        #etag, last_modified: the validators sent by the server
+        #body: the page (compressed)
+        #stored: the time of the last download of the page
+        #used: the time of the last use of the page
+        cache.execute("""CREATE TABLE IF NOT EXISTS pages (
+                         url TEXT PRIMARY KEY,
+                         etag TEXT,
+                         last_modified TEXT,
+                         body BLOB,
+                         stored INTEGER,
+                         used INTEGER)""")
+        cache.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+        cache.commit()
+        self.cache = cache
+        return cache
+
+    def _cache_get(self, url):
+        """this function returns the cached page of an url as
+        (etag, last modified, body), None if it's not in the cache
+        arg 1: the url
+        """
+        with self.cache_lock:
+            cache = self._getCache()
+            row = cache.execute(
+                "SELECT etag, last_modified, body, stored FROM pages WHERE url = (?)",
+                (url, )
+                ).fetchone()
+            if row is None:
+                return None
+            if row[3] < time.time() - self.ttl:
+                cache.execute("DELETE FROM pages WHERE url = (?)", (url, ))
+                cache.commit()
+                return None
+            return row[0], row[1], zlib.decompress(row[2])
+
+    def _cache_put(self, url, etag, last_modified, body):
+        """this function puts a page in the cache,
+        and removes the least recently used pages if it's full
+        arg 1: the url
+        arg 2: the ETag of the page
+        arg 3: the Last-Modified date of the page
+        arg 4: the page
+        """
+        now = int(time.time())
+        with self.cache_lock:
+            cache = self._getCache()
+            cache.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, zlib.compress(body), now, now)
+                )
+            cache.execute(
+                """DELETE FROM pages WHERE url IN (
+                   SELECT url FROM pages ORDER BY used DESC LIMIT -1 OFFSET (?))""",
+                (self.max_entries, )
+                )
+            cache.commit()
+
+    def _cache_touch(self, url):
+        """this function marks a cached page as used (and revalidated)
+        arg 1: the url
+        """
+        now = int(time.time())
+        with self.cache_lock:
+            cache = self._getCache()
+            cache.execute(
+                "UPDATE pages SET used = (?), stored = (?) WHERE url = (?)",
+                (now, now, url)
+                )
+            cache.commit()
+
+    def _connection(self, scheme, netloc):
+        """this function returns the connexion of the current thread
+        to a server, it's opened if needed
+        arg 1: the scheme (http or https)
+        arg 2: the server (host[:port])
+        """
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, netloc)
+        if key not in self.local.connections:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            self.local.connections[key] = conn
+        return self.local.connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        """this function closes the connexion of the current thread
+        to a server (after an error)
+        arg 1: the scheme (http or https)
+        arg 2: the server (host[:port])
+        """
+        conn = self.local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def fetch(self, url, redirects=3):
+        """this function downloads a page, it returns (page, changed),
+        changed is False if the page is the same as the one in the cache.
+        It returns None if the page could not be downloaded.
+        arg 1: the url of the page
+        arg 2: the maximum number of redirections followed
+        """
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        cached = self._cache_get(url)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        if cached is not None:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                conn = self._connection(parsed.scheme, parsed.netloc)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                #the connexion may be broken, we open a new one
+                self._drop_connection(parsed.scheme, parsed.netloc)
+                self.log.warning('error downloading %s (%s), try %d/%d',
+                        url, e, attempt + 1, self.retries + 1)
+                continue
+            if response.getheader('Connection', '').lower() == 'close':
+                self._drop_connection(parsed.scheme, parsed.netloc)
+
+            if response.status == 304 and cached is not None:
+                self._cache_touch(url)
+                return cached[2], False
+            if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+                location = urllib.parse.urljoin(url, response.getheader('Location', ''))
+                return self.fetch(location, redirects - 1)
+            if response.status == 429 or response.status >= 500:
+                self.log.warning('error downloading %s (HTTP %d), try %d/%d',
+                        url, response.status, attempt + 1, self.retries + 1)
+                continue
+            if response.status != 200:
+                self.log.warning('could not download %s (HTTP %d)',
+                        url, response.status)
+                return None
+
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            etag = response.getheader('ETag')
+            last_modified = response.getheader('Last-Modified')
+            if etag or last_modified:
+                self._cache_put(url, etag, last_modified, body)
+            return body, True
+
+        self.log.warning('could not download %s',url)
+        return None
+
+
+class Area(object):
+    """This Class is the area of a geographic search, a circle
+    ("lat,lon,km") or a polygon ("lat,lon;lat,lon;lat,lon[;...]")
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        points = [tuple(float(x) for x in point.split(',')) for point in spec.split(';')]
+        if len(points) == 1 and len(points[0]) == 3:
+            lat, lon, km = points[0]
+            if km <= 0:
+                raise ValueError('the radius must be positive')
+            self.center = (lat, lon)
+            self.km = km
+            self.polygon = None
+            #the degrees of latitude and longitude of km kilometers
+            dlat = km / 111.32
+            dlon = km / (111.32 * max(0.01, math.cos(math.radians(lat))))
+            self.bbox = (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        elif len(points) >= 3 and all(len(point) == 2 for point in points):
+            self.center = None
+            self.km = None
+            self.polygon = points
+            lats = [point[0] for point in points]
+            lons = [point[1] for point in points]
+            self.bbox = (min(lats), max(lats), min(lons), max(lons))
+        else:
+            raise ValueError('not a circle or a polygon: %s' % spec)
+        for lat in self.bbox[:2]:
+            if not -90 <= lat <= 90:
+                raise ValueError('invalid latitude: %s' % lat)
+
+    def __str__(self):
+        return self.spec
+
+    def contains(self, lat, lon):
+        """returns True if the point is inside the area
+        arg 1: the latitude
+        arg 2: the longitude
+        """
+        min_lat, max_lat, min_lon, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.polygon is None:
+            #haversine distance to the center
+            lat1, lon1 = math.radians(self.center[0]), math.radians(self.center[1])
+            lat2, lon2 = math.radians(lat), math.radians(lon)
+            a = math.sin((lat2 - lat1) / 2) ** 2 + \
+                math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+            return 2 * 6371.0 * math.asin(math.sqrt(a)) <= self.km
+        #ray casting
+        inside = False
+        j = len(self.polygon) - 1
+        for i in range(len(self.polygon)):
+            lat_i, lon_i = self.polygon[i]
+            lat_j, lon_j = self.polygon[j]
+            if (lon_i > lon) != (lon_j > lon) and \
+                    lat < (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i:
+                inside = not inside
+            j = i
+        return inside
+
+
+class SearchIndex(object):
+    """This Class is an in-memory index of the active searches, it finds
+    the searches an ad may match: the searches are grouped by postal code
+    and type of ad, and each group is sorted by maximum price, minimum
+    surface and minimum number of rooms, so only the searches passing
+    the most selective of these criteria are checked.
+    A group is rebuilt when one of its searches is added or removed,
+    and replaced at once, so the lookups need no lock.
+    """
+
+    def __init__(self, searches=()):
+        self.lock = threading.Lock()
+        #the searches of each group (postal code, type of ad) by id
+        self.members = {}
+        #the sorted arrays of each group
+        self.groups = {}
+        for search in searches:
+            for key in self._keys(search):
+                self.members.setdefault(key, {})[search['search_id']] = search
+        for key in self.members:
+            self._build(key)
+
+    @staticmethod
+    def _keys(search):
+        cps = search['cps'].split(',') if search.get('cps') else [search['cp']]
+        return [(cp, search['ad_type']) for cp in cps]
+
+    @staticmethod
+    def _number(value, default):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+    def _build(self, key):
+        searches = list(self.members.get(key, {}).values())
+        if not searches:
+            self.groups.pop(key, None)
+            return
+        #(keys, searches) sorted by maximum price, minimum surface and
+        #minimum number of rooms (a search without a criterion accepts all)
+        arrays = []
+        for field, default in (('max_price', float('inf')),
+                ('min_surf', float('-inf')), ('nb_pieces', float('-inf'))):
+            pairs = sorted(((self._number(search[field], default), n)
+                    for n, search in enumerate(searches)))
+            arrays.append(([pair[0] for pair in pairs],
+                    [searches[pair[1]] for pair in pairs]))
+        self.groups[key] = (searches, arrays)
+
+    def add(self, search):
+        """adds a search to the index
+        arg 1: the search (dictionnary, like a row of searches)
+        """
+        with self.lock:
+            for key in self._keys(search):
+                self.members.setdefault(key, {})[search['search_id']] = search
+                self._build(key)
+
+    def remove(self, search_id):
+        """removes a search from the index
+        arg 1: the id of the search
+        """
+        with self.lock:
+            for key, members in list(self.members.items()):
+                if members.pop(search_id, None) is not None:
+                    self._build(key)
+
+    def candidates(self, cp, ad_type, price, surface, rooms):
+        """returns the searches of a postal code and type of ad which
+        may match an ad (the ones passing its most selective criterion)
+        arg 1: the postal code of the ad
+        arg 2: the type of the ad
+        arg 3: the price of the ad (None if unknown)
+        arg 4: the surface of the ad (None if unknown)
+        arg 5: the number of rooms of the ad (None if unknown)
+        """
+        group = self.groups.get((cp, ad_type))
+        if group is None:
+            return ()
+        best, (prices, surfaces, rooms_min) = group
+        #the searches with a maximum price above the price
+        if price is not None:
+            keys, searches = prices
+            i = bisect.bisect_left(keys, price)
+            if len(keys) - i < len(best):
+                best = searches[i:]
+        #the searches with a minimum surface (or rooms) below the ad's
+        for value, (keys, searches) in ((surface, surfaces), (rooms, rooms_min)):
+            if value is not None:
+                i = bisect.bisect_right(keys, value)
+                if i < len(best):
+                    best = searches[:i]
+        return best
+
+
+class KnownAds(object):
+    """This Class is the set of the ads already in the database, and of the
+    (owner, ad) pairs already decided, kept in memory so the known ads
+    of a page are skipped before any SQL. The ids are numbers, they are
+    kept in sorted arrays of 64 bits integers (8 bytes by id), the recent
+    ones in small sets merged into the arrays from time to time, like
+    the removed ones (hidden until the arrays are rebuilt).
+    """
+
+    def __init__(self, ids=(), pairs=(), merge_size=4096):
+        #the number of each owner (the pairs are owner * 2**40 + id)
+        self.owners = {}
+        #the ids which are not numbers (kept as they are)
+        self.other = set()
+        self.merge_size = merge_size
+        self.ads = array.array('q', sorted(set(self._ad_keys(ids))))
+        self.pairs = array.array('q', sorted(set(self._pair_keys(pairs))))
+        self.new_ads = set()
+        self.new_pairs = set()
+        #the keys of the arrays removed since the last merge
+        self.removed_ads = set()
+        self.removed_pairs = set()
+
+    def _ad_keys(self, ids):
+        for annonce_id in ids:
+            if annonce_id.isdigit() and len(annonce_id) < 13:
+                yield int(annonce_id)
+            else:
+                self.other.add(annonce_id)
+
+    def _pair_keys(self, pairs):
+        for owner_id, annonce_id in pairs:
+            if annonce_id.isdigit() and len(annonce_id) < 13:
+                owner = self.owners.setdefault(owner_id, len(self.owners))
+                yield (owner << 40) + int(annonce_id)
+            else:
+                self.other.add((owner_id, annonce_id))
+
+    @staticmethod
+    def _contains(keys, key):
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    @staticmethod
+    def _unique(keys):
+        #the keys are sorted, a key equal to the previous one is skipped
+        previous = None
+        for key in keys:
+            if key != previous:
+                yield key
+                previous = key
+
+    def _merge(self, keys, new, removed):
+        return array.array('q', (key for key in self._unique(heapq.merge(keys, sorted(new)))
+                if key not in removed))
+
+    def has_ad(self, annonce_id):
+        """returns True if the ad is in the database
+        arg 1: the id of the ad
+        """
+        if annonce_id.isdigit() and len(annonce_id) < 13:
+            key = int(annonce_id)
+            return key in self.new_ads or (key not in self.removed_ads
+                    and self._contains(self.ads, key))
+        return annonce_id in self.other
+
+    def has_pair(self, owner_id, annonce_id):
+        """returns True if the ad was already mapped (or not) to the owner
+        arg 1: the owner id
+        arg 2: the id of the ad
+        """
+        if annonce_id.isdigit() and len(annonce_id) < 13:
+            owner = self.owners.get(owner_id)
+            if owner is None:
+                return False
+            key = (owner << 40) + int(annonce_id)
+            return key in self.new_pairs or (key not in self.removed_pairs
+                    and self._contains(self.pairs, key))
+        return (owner_id, annonce_id) in self.other
+
+    def add(self, ids, pairs):
+        """adds ads and (owner, ad) pairs to the set
+        arg 1: the ids of the ads
+        arg 2: the (owner id, ad id) pairs
+        """
+        #an ad removed then added again is just not hidden anymore
+        ads = set(self._ad_keys(ids))
+        self.new_ads.update(ads - self.removed_ads)
+        self.removed_ads.difference_update(ads)
+        pairs = set(self._pair_keys(pairs))
+        self.new_pairs.update(pairs - self.removed_pairs)
+        self.removed_pairs.difference_update(pairs)
+        self._flush()
+
+    def remove(self, ids, pairs):
+        """removes ads and (owner, ad) pairs from the set
+        arg 1: the ids of the ads
+        arg 2: the (owner id, ad id) pairs
+        """
+        for annonce_id in ids:
+            if annonce_id.isdigit() and len(annonce_id) < 13:
+                key = int(annonce_id)
+                self.new_ads.discard(key)
+                if self._contains(self.ads, key):
+                    self.removed_ads.add(key)
+            else:
+                self.other.discard(annonce_id)
+        for owner_id, annonce_id in pairs:
+            if annonce_id.isdigit() and len(annonce_id) < 13:
+                owner = self.owners.get(owner_id)
+                if owner is None:
+                    continue
+                key = (owner << 40) + int(annonce_id)
+                self.new_pairs.discard(key)
+                if self._contains(self.pairs, key):
+                    self.removed_pairs.add(key)
+            else:
+                self.other.discard((owner_id, annonce_id))
+        self._flush()
+
+    def _flush(self):
+        #the arrays are rebuilt once enough keys were added or removed
+        if len(self.new_ads) + len(self.removed_ads) > self.merge_size:
+            self.ads = self._merge(self.ads, self.new_ads, self.removed_ads)
+            self.new_ads = set()
+            self.removed_ads = set()
+        if len(self.new_pairs) + len(self.removed_pairs) > self.merge_size:
+            self.pairs = self._merge(self.pairs, self.new_pairs, self.removed_pairs)
+            self.new_pairs = set()
+            self.removed_pairs = set()
+
+    def size(self):
+        """returns the number of ads and pairs, and the memory used (bytes)
+        """
+        ads = len(self.ads) + len(self.new_ads) - len(self.removed_ads)
+        pairs = len(self.pairs) + len(self.new_pairs) - len(self.removed_pairs)
+        memory = self.ads.buffer_info()[1] * self.ads.itemsize + \
+            self.pairs.buffer_info()[1] * self.pairs.itemsize + \
+            sys.getsizeof(self.new_ads) + sys.getsizeof(self.new_pairs) + \
+            sys.getsizeof(self.removed_ads) + sys.getsizeof(self.removed_pairs) + \
+            sys.getsizeof(self.other)
+        return ads, pairs, memory
+
+
+# converts a comma separated list of postal codes
+def _postal_codes(text):
+    cps = [cp for cp in text.split(',') if cp]
+    if not cps or not all(cp.isdigit() for cp in cps):
+        raise ValueError('not a list of postal codes: %s' % text)
+    return ','.join(cps)
+
+
+class Ad(collections.namedtuple('Ad', (
+        #the elements we get from the xml
+        'idTiers', 'idAnnonce', 'idPublication', 'idTypeTransaction',
+        'idTypeBien', 'dtFraicheur', 'dtCreation', 'titre', 'libelle',
+        'proximite', 'descriptif', 'prix', 'prixUnite', 'prixMention',
+        'nbPiece', 'nbChambre', 'surface', 'surfaceUnite', 'idPays', 'pays',
+        'cp', 'ville', 'nbPhotos', 'firstThumb', 'permaLien', 'latitude',
+        'longitude', 'llPrecision',
+        #the values converted at ingest
+        'prix_num', 'surface_num', 'nbPiece_num', 'dtCreation_ts',
+        'latitude_num', 'longitude_num',
+        #the cluster of the ad (same flat)
+        'cluster_id',
+        #the mapping of the ad (None if the ad is read without its owner)
+        'owner_id', 'uniq_id'))):
+    """This Class is an ad read from the database, a tuple whose fields
+    are read as attributes (ad.prix_num) or as keys (ad['prix'])
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
 class SqliteSeLogerDB(object):
     """This Class is the backend of the plugin,
     it handles the database, its creation, its updates,
     it also provides methods to get the ads information
     """
 
-    def __init__(self, log, filename='db.seloger'):
+    def __init__(self, log, filename='db.seloger', max_workers=8, timeout=30,
+            wal=False, fetcher=None, exclusions=None, max_age=30,
+            poll_floor=60, poll_ceiling=3600, request_budget=30,
+            retention=None, archive=None, market_window=90):
         self.dbs = {} 
+        self.db_lock = threading.Lock()
         self.filename = filename
         self.log = log
+        #the object downloading the pages (it must provide fetch(url))
+        if fetcher is None:
+            fetcher = HttpFetcher(log, timeout=timeout)
+        self.fetcher = fetcher
+        #the next page of each page already read, and the searches
+        #it was read for (to skip the pages which didn't change)
+        self.page_links = {}
+        #use the WAL journal (with synchronous=NORMAL) instead of
+        #the default rollback journal, less fsync for each commit
+        self.wal = wal
+        #if SQLite can return the changed rows (RETURNING, SQLite 3.35)
+        self.returning = False
+        #the number of pages downloaded in parallel
+        self.max_workers = max_workers
+        self.pool = None
+        #the timeout (in seconds) of each download
+        self.timeout = timeout
         #the elements we get from the xml
         self.val_xml = (
             'idTiers', 
@@ -69,6 +646,146 @@ class SqliteSeLogerDB(object):
         self.val_xml_count = len(self.val_xml)
         #the primary key of the results table
         self.primary_key = 'idAnnonce'
+        #the delivery states of an ad (flag_shown of map)
+        self.DELIVERED = 0
+        self.PENDING = 1
+        self.IN_FLIGHT = 2
+        self.FAILED = 3
+        #failed max_failures times, never delivered (terminal)
+        self.DROPPED = 4
+        #a failed ad is claimed again after failure_delay seconds,
+        #doubled after each failure, and dropped after max_failures
+        self.failure_delay = 300
+        self.max_failures = 5
+        #the rules excluding ads: an ad is ignored if the given field
+        #contains (case insensitive) one of the given strings
+        if exclusions is None:
+            exclusions = (
+                {'field': 'descriptif', 'contains': ['viager']},
+                {'field': 'permaLien', 'contains': ['/viagers/']},
+            )
+        self.exclusions = self._compile_exclusions(exclusions)
+        #ads older than max_age days are ignored
+        self.max_age = max_age
+        #the dates of the ads ('%Y-%m-%dT%H:%M:%S', the only ones we can format)
+        self.date_format = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d$')
+        self._set_cutoff()
+        #the typed columns shadowing the TEXT ones
+        #(table, column, sql type, source column, conversion)
+        self.typed_columns = (
+            ('results', 'prix_num', 'REAL', 'prix', self._to_float),
+            ('results', 'surface_num', 'REAL', 'surface', self._to_float),
+            ('results', 'nbPiece_num', 'INTEGER', 'nbPiece', self._to_int),
+            ('results', 'dtCreation_ts', 'INTEGER', 'dtCreation', self._to_timestamp),
+            ('results', 'latitude_num', 'REAL', 'latitude', self._to_float),
+            ('results', 'longitude_num', 'REAL', 'longitude', self._to_float),
+            ('searches', 'min_surf_num', 'REAL', 'min_surf', self._to_float),
+            ('searches', 'max_price_num', 'REAL', 'max_price', self._to_float),
+            ('searches', 'nb_pieces_num', 'INTEGER', 'nb_pieces', self._to_int),
+        )
+        #the schema migrations, in order, the version of a database
+        #is the number of migrations already played on it
+        #(stored in PRAGMA user_version)
+        self.migrations = (
+            self._migration_indexes,
+            self._migration_typed_columns,
+            self._migration_stats,
+            self._migration_search_state,
+            self._migration_outbox,
+            self._migration_outbox_ads,
+            self._migration_poll_state,
+            self._migration_retention,
+            self._migration_clusters,
+            self._migration_geo,
+            self._migration_market,
+            self._migration_stats_versions,
+            self._migration_delivery_failures,
+        )
+        #the minimum time (in seconds) between two full sweeps of a search,
+        #between two sweeps, the pages of a search are read until
+        #a page contains only known ads older than the last ones seen
+        self.sweep_interval = 6 * 3600
+        #each query is polled at its own interval (in seconds), between
+        #poll_floor and poll_ceiling, depending on the number of new ads
+        #it gets: the interval aims at poll_ads new ads between two polls,
+        #and doubles each time a poll brings nothing new
+        self.poll_floor = poll_floor
+        self.poll_ceiling = poll_ceiling
+        self.poll_ads = 0.5
+        #the interval of a query not polled yet
+        self.poll_interval = 300
+        #the period (in seconds) used to compute the arrival rate of the ads
+        self.rate_period = 7 * 86400
+        #no more than request_budget pages downloaded per minute
+        #(a query already started can overdraw the budget to finish)
+        self.budget = TokenBucket(request_budget / 60.0, request_budget)
+        #filter on map and results of the ads which are not covered
+        #by an active search of their owner (same type and postal code,
+        #or one of the postal codes of a geographic search)
+        self.orphan_where = """NOT EXISTS (
+                SELECT 1 FROM searches
+                WHERE searches.owner_id = map.owner_id
+                AND searches.ad_type = map.ad_type
+                AND (searches.cp = results.cp
+                     OR ',' || searches.cps || ',' LIKE '%,' || results.cp || ',%')
+                AND searches.flag_active = 1)"""
+        #the columns of results selected for an Ad (followed by
+        #the owner and the uniq id of the mapping)
+        self.ad_select = ', '.join('results.' + field for field in Ad._fields[:-2])
+        #the areas of the geographic searches (by spec)
+        self.areas = {}
+        #the index of the active searches (loaded at the first use)
+        self.index = None
+        self.index_lock = threading.Lock()
+        #the ads and the (owner, ad) pairs already known (loaded at the
+        #first use, updated when ads or mappings are inserted or deleted
+        #under known_lock)
+        self.known = None
+        self.known_lock = threading.RLock()
+        #the ads and the mappings skipped by the last refresh
+        self.skipped_ads = 0
+        self.skipped_mappings = 0
+        #number of rows updated by transaction when backfilling a table
+        self.migration_chunk = 1000
+        #the number of days an ad is kept for each type of ad
+        #(the ads older than max_age are ignored anyway)
+        if retention is None:
+            retention = {'1': 90, '2': 180}
+        self.retention = retention
+        #the database where the expired ads are archived (None: no archive)
+        self.archive_filename = archive
+        self.archive = None
+        #the ads mapped to nobody are kept market_window days for the
+        #market stats (see get_market_columns)
+        self.market_window = market_window
+        #the rows deleted by transaction when pruning, and the pause
+        #(in seconds) between two transactions to let the other writers in
+        self.prune_chunk = 500
+        self.prune_pause = 0.05
+        #the part of free pages of the database from which it's compacted
+        self.vacuum_ratio = 0.2
+        #the same flat listed by several agencies is one cluster of ads,
+        #an owner gets only the first ad of a cluster. The candidates
+        #are found with a MinHash of the description (dedup_hashes
+        #hashes, by bands of dedup_rows hashes: two ads sharing a band
+        #are candidates) and with the rounded position of the flat
+        self.dedup_hashes = 32
+        self.dedup_rows = 4
+        rand = random.Random(0)
+        self.dedup_masks = tuple(rand.getrandbits(64) for i in range(self.dedup_hashes))
+        #two candidates are the same flat if they have the same number of
+        #rooms and their prices and surfaces differ by less than this part
+        self.dedup_tolerance = 0.03
+        #and, if both positions are known, are less than this
+        #distance (in meters) from each other
+        self.dedup_distance = 100
+        self.words = re.compile(r'\w+')
+
+    @staticmethod
+    def _ad_factory(cursor, row):
+        """small function building an Ad from a row selected with ad_select
+        """
+        return Ad._make(row)
 
     def _dict_factory(self, cursor, row):
         """just a small trick to get returns from the
@@ -79,12 +796,66 @@ class SqliteSeLogerDB(object):
             d[col[0]] = row[idx]
         return d
 
+    @staticmethod
+    def _to_float(value):
+        """small function converting a value to a float (None if it's not a number)
+        """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _to_int(value):
+        """small function converting a value to an int (None if it's not a number)
+        """
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _to_timestamp(value):
+        """small function converting a date from SeLoger to a timestamp
+        (None if it's not a date)
+        """
+        try:
+            return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+        except (TypeError, ValueError):
+            return None
+
+    def _typed_values(self, table, values):
+        """this function returns the values of the typed columns of a table
+        arg 1: the table
+        arg 2: the values of the row (dictionnary)
+        """
+        return tuple(convert(values[source]) for t, column, sql_type, source, convert
+                in self.typed_columns if t == table)
+
+    def _typed_names(self, table):
+        """this function returns the names of the typed columns of a table
+        arg 1: the table
+        """
+        return tuple(column for t, column, sql_type, source, convert
+                in self.typed_columns if t == table)
+
     def close(self):
         """function closing the database cleanly
         """
-        for db in self.dbs.itervalues():
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        for db in self.dbs.values():
             db.close()
 
+    def _getPool(self):
+        """this function returns the pool of workers downloading the pages,
+        it's kept between two refreshes so the workers keep their connexions
+        no argument.
+        """
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.pool
+
     def _getDb(self):
         """this function returns a database connexion, if the
         database doesn't exist, it creates it.
@@ -95,18 +866,32 @@ class SqliteSeLogerDB(object):
         except ImportError:
             raise Exception('You need to have sqlite3 installed to ' \
                                    'use SeLoger.')
-        filename = 'db.seloger'
-
-        if filename in self.dbs:
-            return self.dbs[filename]
-        if os.path.exists(filename):
-            self.dbs[filename] = sqlite3.connect(
-                filename, check_same_thread = False
-                )
+        filename = self.filename
+        self.returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+        #each thread has its own connexion, so the transactions
+        #of the different threads don't mix
+        key = (filename, threading.get_ident())
+        if key in self.dbs:
+            return self.dbs[key]
+        with self.db_lock:
+            exists = os.path.exists(filename)
+            db = sqlite3.connect(filename, check_same_thread = False,
+                    timeout = 60)
+            self.dbs[key] = db
+            if self.wal:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('PRAGMA synchronous=NORMAL')
+            if not exists:
+                self._create_tables(db)
+            self._migrate(db)
+        return db
 
-            return self.dbs[filename]
-        db = sqlite3.connect(filename, check_same_thread = False)
-        self.dbs[filename] = db
+    def _create_tables(self, db):
+        """this function creates the tables of a new database
+        arg 1: the database connexion
+        """
+        filename = self.filename
         cursor = db.cursor()
 
         #initialisation of the searches table 
@@ -134,8 +919,9 @@ class SqliteSeLogerDB(object):
         #mapping between a search result and a user (n to n mapping)
         #idAnnonce: the id of on annonce
         #owner_id: the id of an owner
-        #flag_shown: a flag set to 0 when the annonce was already 
-        #           presented to owner_id, 0 if not
+        #flag_shown: the delivery state of the annonce to owner_id:
+        #           1 -> pending, 2 -> in-flight (queued in the outbox),
+        #           0 -> delivered, 3 -> failed (will be retried)
         cursor.execute("""CREATE TABLE map (
                           uniq_id TEXT PRIMARY KEY,
                           idAnnonce TEXT,
@@ -165,265 +951,2122 @@ class SqliteSeLogerDB(object):
 
         db.commit()
         self.log.info('database %s created',filename)
-        return db
+
+    def _migrate(self, db):
+        """this function upgrades the schema of the database,
+        it plays the migrations not already played on it, each one
+        is recorded in PRAGMA user_version once done
+        arg 1: the database connexion
+        """
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        for number, migration in enumerate(self.migrations, 1):
+            if number <= version:
+                continue
+            self.log.info('migrating database %s to version %d',
+                    self.filename, number)
+            migration(db)
+            cursor.execute("PRAGMA user_version = %d" % number)
+            db.commit()
+
+    def _add_column(self, db, table, column, sql_type):
+        """this function adds a column to a table if it's not already there
+        arg 1: the database connexion
+        arg 2: the table
+        arg 3: the new column
+        arg 4: the type of the new column
+        """
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute("PRAGMA table_info(%s)" % table)
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, sql_type))
+
+    def _migration_indexes(self, db):
+        """migration 1: indexes used by get_new and get_all
+        """
+        cursor = db.cursor()
+        cursor.execute("""CREATE INDEX IF NOT EXISTS map_owner_type
+                          ON map (owner_id, ad_type)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS map_shown
+                          ON map (flag_shown)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS results_cp
+                          ON results (cp)""")
+        db.commit()
+
+    def _migration_typed_columns(self, db):
+        """migration 2: typed (REAL/INTEGER) columns shadowing the TEXT ones,
+        the existing rows are converted by chunks, one transaction by chunk,
+        so the database stays usable during the upgrade
+        """
+        for table, column, sql_type, source, convert in self.typed_columns:
+            self._add_column(db, table, column, sql_type)
+        db.commit()
+
+        for table in ('results', 'searches'):
+            names = self._typed_names(table)
+            sources = [source for t, column, sql_type, source, convert
+                    in self.typed_columns if t == table]
+            cursor = db.cursor()
+            cursor.row_factory = None
+            last = 0
+            while True:
+                cursor.execute(
+                    "SELECT rowid, %s FROM %s WHERE rowid > (?) ORDER BY rowid LIMIT (?)"
+                    % (', '.join(sources), table),
+                    (last, self.migration_chunk)
+                    )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for row in rows:
+                    values = dict(zip(sources, row[1:]))
+                    updates.append(self._typed_values(table, values) + (row[0], ))
+                cursor.executemany(
+                    "UPDATE %s SET %s WHERE rowid = (?)"
+                    % (table, ', '.join('%s = (?)' % name for name in names)),
+                    updates
+                    )
+                db.commit()
+                last = rows[-1][0]
+
+        cursor = db.cursor()
+        cursor.execute("""CREATE INDEX IF NOT EXISTS results_dtCreation
+                          ON results (dtCreation_ts)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS searches_active
+                          ON searches (flag_active)""")
+        db.commit()
+
+    def _migration_stats(self, db):
+        """migration 3: summary table of the stats (filled from the
+        ads already mapped by migration 12)
+        """
+        cursor = db.cursor()
+        #the stats of the ads of an owner, by postal code, number of
+        #rooms and surface (by range of 1 square meter)
+        #number: the number of ads
+        #sum_price, sum_surface, sum_price_m2: the sums of the price,
+        #           of the surface and of the price per square meter
+        cursor.execute("""CREATE TABLE IF NOT EXISTS stats (
+                          owner_id TEXT,
+                          ad_type TEXT,
+                          cp TEXT,
+                          rooms INTEGER,
+                          surface_range INTEGER,
+                          number INTEGER,
+                          sum_price REAL,
+                          sum_surface REAL,
+                          sum_price_m2 REAL,
+                          PRIMARY KEY (owner_id, ad_type, cp, rooms, surface_range))"""
+                      )
+        db.commit()
+
+    def _migration_search_state(self, db):
+        """migration 4: state of each upstream query between two refreshes
+        """
+        cursor = db.cursor()
+        #url: the url of the first page of the query
+        #hwm: the creation date (timestamp) of the most recent ad seen
+        #last_sweep: the date (timestamp) of the last time all the pages
+        #            of the query were read
+        cursor.execute("""CREATE TABLE IF NOT EXISTS search_state (
+                          url TEXT PRIMARY KEY,
+                          hwm INTEGER,
+                          last_sweep INTEGER)"""
+                      )
+        db.commit()
+
+    def _migration_outbox(self, db):
+        """migration 5: queue of the messages waiting to be sent to slack
+        """
+        cursor = db.cursor()
+        #msg_id: the id of the message (the order of the queue)
+        #channel: the channel (or user) the message is sent to
+        #text: the message
+        #created: the date (timestamp) the message was queued
+        #attempts: the number of failed attempts to send it
+        #next_try: the date (timestamp) of the next attempt
+        cursor.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                          msg_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          channel TEXT,
+                          text TEXT,
+                          created INTEGER,
+                          attempts INTEGER,
+                          next_try INTEGER)"""
+                      )
+        cursor.execute("""CREATE INDEX IF NOT EXISTS outbox_next_try
+                          ON outbox (next_try)""")
+        db.commit()
+
+    def _migration_outbox_ads(self, db):
+        """migration 6: the ads carried by each queued message
+        """
+        cursor = db.cursor()
+        #msg_id: the id of the message in the outbox
+        #uniq_id: the mapping (ad, owner) the message delivers
+        cursor.execute("""CREATE TABLE IF NOT EXISTS outbox_ads (
+                          msg_id INTEGER,
+                          uniq_id TEXT)"""
+                      )
+        cursor.execute("""CREATE INDEX IF NOT EXISTS outbox_ads_msg
+                          ON outbox_ads (msg_id)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS outbox_ads_uniq
+                          ON outbox_ads (uniq_id)""")
+        db.commit()
+
+    def _migration_poll_state(self, db):
+        """migration 7: polling schedule of each upstream query
+        """
+        #signature: the searches the query was polled for
+        #rate: the number of new ads per hour
+        #interval: the time (in seconds) between two polls
+        #next_poll: the date (timestamp) of the next poll
+        self._add_column(db, 'search_state', 'signature', 'TEXT')
+        self._add_column(db, 'search_state', 'rate', 'REAL')
+        self._add_column(db, 'search_state', 'interval', 'INTEGER')
+        self._add_column(db, 'search_state', 'next_poll', 'INTEGER')
+        #the ads of a postal code created since a date (arrival rate)
+        db.cursor().execute("""CREATE INDEX IF NOT EXISTS results_cp_created
+                               ON results (cp, dtCreation_ts)""")
+        db.commit()
+
+    def _migration_retention(self, db):
+        """migration 8: index used to find the ads without owner
+        """
+        db.cursor().execute("""CREATE INDEX IF NOT EXISTS map_annonce
+                               ON map (idAnnonce)""")
+        db.commit()
+
+    def _migration_clusters(self, db):
+        """migration 9: clusters of the ads of the same flat, the existing
+        ads are their own cluster, their fingerprints are added by chunks
+        """
+        #band: the hash of a band of the fingerprint of an ad
+        #cluster_id: the cluster of the ad
+        self._add_column(db, 'results', 'cluster_id', 'TEXT')
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute("""CREATE TABLE IF NOT EXISTS lsh (
+                          band INTEGER,
+                          cluster_id TEXT,
+                          UNIQUE (band, cluster_id) ON CONFLICT IGNORE)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS lsh_cluster ON lsh (cluster_id)")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS results_cluster
+                          ON results (cluster_id)""")
+        db.commit()
+        fields = ('idAnnonce', 'cp', 'nbPiece', 'surface', 'latitude',
+                'longitude', 'descriptif')
+        last = 0
+        while True:
+            cursor.execute(
+                "SELECT rowid, %s FROM results WHERE rowid > (?) ORDER BY rowid LIMIT (?)"
+                % ', '.join(fields),
+                (last, self.migration_chunk)
+                )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            lsh_rows = []
+            for row in rows:
+                values = dict(zip(fields, row[1:]))
+                for band in self._fingerprint(values):
+                    lsh_rows.append((band, values['idAnnonce']))
+            cursor.executemany("INSERT INTO lsh VALUES (?, ?)", lsh_rows)
+            cursor.execute(
+                """UPDATE results SET cluster_id = idAnnonce
+                   WHERE rowid > (?) AND rowid <= (?)""",
+                (last, rows[-1][0])
+                )
+            db.commit()
+            last = rows[-1][0]
+
+    def _migration_geo(self, db):
+        """migration 10: geographic searches, and a spatial index
+        (R*Tree) of the positions of the ads, filled by chunks
+        """
+        #cps: the postal codes fetched for a geographic search
+        #geo: the area of a geographic search (see Area)
+        self._add_column(db, 'searches', 'cps', 'TEXT')
+        self._add_column(db, 'searches', 'geo', 'TEXT')
+        cursor = db.cursor()
+        cursor.row_factory = None
+        #id: the rowid of the ad in results
+        cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS results_geo
+                          USING rtree(id, min_lat, max_lat, min_lon, max_lon)""")
+        db.commit()
+        last = 0
+        while True:
+            cursor.execute(
+                "SELECT MAX(rowid) FROM (SELECT rowid FROM results WHERE rowid > (?) " \
+                "ORDER BY rowid LIMIT (?))",
+                (last, self.migration_chunk)
+                )
+            end = cursor.fetchone()[0]
+            if end is None:
+                break
+            self._index_positions(cursor, "rowid > (?) AND rowid <= (?)", (last, end))
+            db.commit()
+            last = end
+
+    def _migration_market(self, db):
+        """migration 11: covering index of the market stats (see
+        get_market_columns), they are read without touching the ads
+        """
+        db.cursor().execute("""CREATE INDEX IF NOT EXISTS results_market
+                               ON results (cp, idTypeTransaction, dtCreation_ts,
+                               prix_num, surface_num, nbPiece_num, cluster_id, idAnnonce)""")
+        db.commit()
+
+    def _migration_stats_versions(self, db):
+        """migration 12: version of the stats of each owner, type of ad
+        and postal code, the stats are computed again from the ads
+        already mapped (which sets the versions)
+        """
+        #version: incremented each time the stats change
+        db.cursor().execute("""CREATE TABLE IF NOT EXISTS stats_versions (
+                               owner_id TEXT,
+                               ad_type TEXT,
+                               cp TEXT,
+                               version INTEGER,
+                               PRIMARY KEY (owner_id, ad_type, cp))""")
+        self._rebuild_stats(db)
+
+    def _migration_delivery_failures(self, db):
+        """migration 13: the failed deliveries of each ad
+        """
+        #failures: the number of times the delivery of the ad failed
+        #retry_at: the date (timestamp) from which a failed ad is claimed again
+        self._add_column(db, 'map', 'failures', 'INTEGER')
+        self._add_column(db, 'map', 'retry_at', 'INTEGER')
+        db.commit()
+
+    def _index_positions(self, cursor, where, params):
+        """this function adds the positions of ads to the spatial index,
+        it doesn't commit
+        arg 1: the cursor
+        arg 2: the filter on results
+        arg 3: the parameters of the filter
+        """
+        cursor.execute(
+            """INSERT OR IGNORE INTO results_geo
+               SELECT rowid, latitude_num, latitude_num, longitude_num, longitude_num
+               FROM results WHERE latitude_num IS NOT NULL
+               AND longitude_num IS NOT NULL AND """ + where,
+            params
+            )
 
     def _get_annonce(self, idAnnonce):
         """backend function getting the information of one ad
            arg 1: the ad unique ID ('idAnnonce') 
         """
         db = self._getDb()
-        db.row_factory = self._dict_factory
         cursor = db.cursor()
+        cursor.row_factory = self._ad_factory
         cursor.execute(
-            """SELECT * FROM results WHERE idAnnonce = (?)""",
+            "SELECT " + self.ad_select + ", NULL, NULL FROM results WHERE idAnnonce = (?)",
             (idAnnonce, )
             )
         return cursor.fetchone()
 
-    def _search_seloger(self, cp, min_surf, max_price, ad_type, owner_id, nb_pieces_min):
-        """entry function for getting the ads on seloger.com
+    def _expand_searches(self, searches):
+        """this function returns the searches with a geographic search
+        for each of its postal codes (so each postal code is fetched once
+        for all the searches covering it)
+        arg 1: the list of active searches
+        """
+        expanded = []
+        for search in searches:
+            if not search.get('cps'):
+                expanded.append(search)
+                continue
+            for cp in search['cps'].split(','):
+                search_cp = dict(search)
+                search_cp['cp'] = cp
+                expanded.append(search_cp)
+        return expanded
+
+    def _plan_searches(self, searches):
+        """this function groups the active searches by upstream query
+        (same postal code and same type of ad), so that each query
+        is fetched only once per refresh. The criteria of a group
+        are widened to the loosest ones of its searches.
+        arg 1: the list of active searches
+        """
+        plan = collections.OrderedDict()
+        for search in searches:
+            key = (search['cp'], search['ad_type'])
+            if key not in plan:
+                plan[key] = {
+                    'cp': search['cp'],
+                    'ad_type': search['ad_type'],
+                    'min_surf': search['min_surf'],
+                    'max_price': search['max_price'],
+                    'nb_pieces': search['nb_pieces'],
+                    'searches': [],
+                    }
+            group = plan[key]
+            #we widen the query to the loosest criteria of the group
+            group['min_surf'] = min(group['min_surf'], search['min_surf'], key=float)
+            group['max_price'] = max(group['max_price'], search['max_price'], key=float)
+            group['nb_pieces'] = min(group['nb_pieces'], search['nb_pieces'], key=int)
+            group['searches'].append(search)
+        return list(plan.values())
+
+    def _match_search(self, search, values):
+        """this function checks if an ad matches the criteria of one search
+        (the upstream query of its group can be looser than the search).
+        If a value of the ad is not a number, we trust seloger.com filter.
+        arg 1: the search
+        arg 2: the values of the ad (dictionnary)
+        """
+        try:
+            if float(values['prix']) > float(search['max_price']):
+                return False
+        except ValueError:
+            pass
+        try:
+            if float(values['surface']) < float(search['min_surf']):
+                return False
+        except ValueError:
+            pass
+        try:
+            if int(values['nbPiece']) < int(search['nb_pieces']):
+                return False
+        except ValueError:
+            pass
+        #a geographic search needs the ad to be inside its area
+        if search.get('geo'):
+            lat = self._to_float(values['latitude'])
+            lon = self._to_float(values['longitude'])
+            if lat is None or lon is None or not self._area(search['geo']).contains(lat, lon):
+                return False
+        return True
+
+    def _area(self, spec):
+        """this function returns the area of a geographic search
+        arg 1: the spec of the area
+        """
+        area = self.areas.get(spec)
+        if area is None:
+            area = self.areas[spec] = Area(spec)
+        return area
+
+    def _search_url(self, cp, min_surf, max_price, ad_type, nb_pieces_min):
+        """this function builds the url of the first page of a search
+        on seloger.com
         arg 1: the postal code
         arg 2: the minimal surface
         arg 3: the maximum rent
         arg 4: type of the add (1 -> location, 2 -> sell) 
-        arg 5: the owner_id of the search (the user making the search)
-        arg 6: nb_pieces_min, minimum number of rooms 
-
+        arg 5: nb_pieces_min, minimum number of rooms 
         """
-        owner_id.lower() 
-        #the first url for the search
         nb_pieces_search = ','.join([str(x) for x in range(int(nb_pieces_min), 20)])
-        url = 'http://ws.seloger.com/search.xml?cp=' + cp + \
+        return 'http://ws.seloger.com/search.xml?cp=' + cp + \
         '&idqfix=1&idtt=' + ad_type + '&idtypebien=1,2&pxmax=' + max_price + \
         '&surfacemin=' + min_surf + '&nb_pieces=' + nb_pieces_search
 
-        #we search all the pages 
-        #(the current page gives the next if it exists)
-        while url is not None:
-                url = self._get(url, ad_type, owner_id)
-
-    def _get(self, url, ad_type, owner_id):
+    def _fetch(self, url):
         """
-        function getting the xml pages  and putting
-        the results inside the database
+        function downloading one xml page, it runs inside the
+        workers of the fetch pool, so it must not touch the database.
+        It returns (page, changed) or None.
         arg 1: the url giving the nice xml
-        arg 2: the owner_id of the search
         """
-        owner_id.lower() 
-        db = self._getDb()
-        cursor = db.cursor()
-
-        #we try to load the xml page
         try:
-            tree = etree.parse(url)
-        except:
+            return self.fetcher.fetch(url)
+        except Exception:
             #if we have some troubles loading the page
-            self.log.warning('could not download %s',url)
+            self.log.exception('could not download %s',url)
             return None
-        
-        #we get the info from the xml
-        root = tree.getroot()
-        annonces = root.find('annonces')
 
-        if annonces is None:
+    def _extract(self, annonce):
+        """
+        function getting the values of one ad, the children of the
+        <annonce> element are walked only once
+        arg 1: the <annonce> element
+        """
+        fields = {}
+        for child in annonce:
+            if child.text is not None:
+                fields.setdefault(child.tag, child.text)
+        #if the value exists we put it in the db
+        #if it doesn't we put "Unknown"
+        return dict((val, fields.get(val, u'Unknown')) for val in self.val_xml)
+
+    def _parse(self, url, data):
+        """
+        function parsing a downloaded xml page, the page is streamed
+        and each ad is dropped from the tree once its values are read.
+        It returns the list of ads and the url of the next page
+        (None if there is no next page), or None if the page
+        has no ads.
+        arg 1: the url of the page
+        arg 2: the content of the page
+        """
+        if data is None:
+            return None
+        ads = []
+        next_url = None
+        has_annonces = False
+        try:
+            for event, element in etree.iterparse(io.BytesIO(data),
+                    events=('end',), tag=('annonce', 'annonces', 'pageSuivante')):
+                parent = element.getparent()
+                if element.tag == 'annonce':
+                    ads.append(self._extract(element))
+                    #we free the ad and the ones before it
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del parent[0]
+                elif element.tag == 'annonces':
+                    has_annonces = True
+                elif parent is not None and parent.tag == 'recherche' \
+                        and parent.getparent() is None:
+                    #the current page gives the next if it exists
+                    next_url = element.text
+        except etree.XMLSyntaxError:
+            self.log.warning('could not parse %s',url)
+            return None
+        if not has_annonces:
             return None
+        return ads, next_url
 
-        for annonce in annonces:
-            values_list=[]
-            for val in self.val_xml:
-                #if the value exists we put it in the db
-                #if it doesn't we put "Unknown"
-                if annonce.find(val) is None or annonce.find(val).text is None:
-                    values_list.append(u'Unknown')
-                else:
-                    values_list.append(str(annonce.find(val).text))
-
-            # ignore ads that are more than 30 days old
-            d = datetime.datetime.strptime(annonce.find('dtCreation').text, '%Y-%m-%dT%H:%M:%S')
-            n = datetime.datetime.now()
-            delta = n.date() - d.date()
-
-            # inserting the ad information inside the table
-            # ignore Viager
-            if not re.match(r'.*[Vv]iager.*', annonce.find('descriptif').text) \
-		and not re.match(r'.*/viagers/.*', annonce.find('permaLien').text) \
-		and delta.days < 30:
-                cursor.execute(
-                        "INSERT INTO results VALUES (" + \
-                        ','.join(itertools.repeat('?', self.val_xml_count)) + ")",
-                        tuple(values_list)
-                        )
+    def _compile_exclusions(self, exclusions):
+        """
+        function compiling the exclusion rules, it returns a list of
+        (field, strings in lower case), the rules on the same field are merged
+        arg 1: the rules (list of {'field': ..., 'contains': [...]})
+        """
+        compiled = collections.OrderedDict()
+        for rule in exclusions:
+            if rule['field'] not in self.val_xml:
+                raise Exception('Unknown field in exclusion rule: %s' % rule['field'])
+            words = compiled.setdefault(rule['field'], [])
+            words.extend(word.lower() for word in rule['contains'])
+        return [(field, tuple(words)) for field, words in compiled.items()]
+
+    def _set_cutoff(self):
+        """
+        function computing the oldest creation day accepted ('YYYY-MM-DD'),
+        it's done once per refresh
+        no argument
+        """
+        oldest = datetime.date.today() - datetime.timedelta(days=self.max_age - 1)
+        self.cutoff = oldest.isoformat()
 
-                annonce_id = annonce.find('idAnnonce').text
+    def _excluded(self, values):
+        """
+        function returning True if an ad must be ignored
+        arg 1: the values of the ad
+        """
+        # ignore ads that are too old (or without a valid date),
+        # the ISO dates are compared as strings, and only the recent
+        # ones are parsed (fromisoformat is much faster than strptime)
+        date = values['dtCreation']
+        if date is None or date[:10] < self.cutoff or not self.date_format.match(date):
+            return True
+        try:
+            datetime.datetime.fromisoformat(date)
+        except ValueError:
+            return True
+
+        # ignore ads matching an exclusion rule (Viager...),
+        # plain substring checks are much faster than regexes here
+        for field, words in self.exclusions:
+            text = values[field].lower()
+            for word in words:
+                if word in text:
+                    return True
+        return False
+
+    def _band(self, *key):
+        """small function hashing a band of a fingerprint to an INTEGER
+        """
+        digest = md5(repr(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'little', signed=True)
 
-                #calcul of the uniq id for the mapping between 
-                #the searcher and the ad
-                uniq_id = md5((owner_id + annonce_id).encode('utf-8')).hexdigest()
+    def _fingerprint(self, values):
+        """
+        function returning the bands of the fingerprint of an ad:
+        the bands of the MinHash of its description, and its rounded
+        position, all with the postal code and the number of rooms
+        arg 1: the values of the ad
+        """
+        cp = values['cp']
+        rooms = values['nbPiece']
+        bands = []
+        #the description without accents or case, by shingles of 3 words
+        text = unicodedata.normalize('NFKD', values['descriptif'] or '')
+        words = self.words.findall(text.encode('ascii', 'ignore').decode('ascii').lower())
+        shingles = set(' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2)))
+        shingles.discard('')
+        if shingles:
+            hashes = [int.from_bytes(md5(shingle.encode('utf-8')).digest()[:8], 'little')
+                    for shingle in shingles]
+            signature = [min(h ^ mask for h in hashes) for mask in self.dedup_masks]
+            for i in range(0, self.dedup_hashes, self.dedup_rows):
+                bands.append(self._band(cp, rooms, i, signature[i:i + self.dedup_rows]))
+        #the same flat at the same place (about 10 meters)
+        latitude = self._to_float(values['latitude'])
+        longitude = self._to_float(values['longitude'])
+        surface = self._to_float(values['surface'])
+        if latitude and longitude and surface:
+            bands.append(self._band(cp, rooms, round(latitude, 4), round(longitude, 4),
+                round(surface)))
+        return bands
+
+    def _same_flat(self, key, other):
+        """
+        function returning True if two candidate ads are the same flat
+        arg 1: (postal code, rooms, price, surface, latitude, longitude) of the first ad
+        arg 2: (postal code, rooms, price, surface, latitude, longitude) of the second ad
+        """
+        if key[0] != other[0] or key[1] != other[1]:
+            return False
+        for a, b in zip(key[2:4], other[2:4]):
+            if a is None or b is None or abs(a - b) > self.dedup_tolerance * max(a, b):
+                return False
+        #two ads with known positions far from each other are two flats
+        #(the agencies often share the same description templates)
+        if key[4] and key[5] and other[4] and other[5]:
+            dlat = (key[4] - other[4]) * 111320
+            dlon = (key[5] - other[5]) * 111320 * math.cos(math.radians(key[4]))
+            if math.hypot(dlat, dlon) > self.dedup_distance:
+                return False
+        return True
+
+    def _clusters(self, cursor, ads):
+        """
+        function returning the cluster of each ad of a page (dictionnary),
+        the new ads join the cluster of a known ad of the same flat, or
+        start their own cluster, their fingerprints are stored
+        arg 1: the cursor
+        arg 2: the ads of the page
+        """
+        if not ads:
+            return {}
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        ids = tuple(values['idAnnonce'] for values in ads)
+        cursor.execute(
+            "SELECT idAnnonce, cluster_id FROM results WHERE idAnnonce IN (" + \
+            ','.join(itertools.repeat('?', len(ids))) + ")",
+            ids
+            )
+        clusters = dict(cursor.fetchall())
+        new = [(values, self._fingerprint(values)) for values in ads
+                if values['idAnnonce'] not in clusters]
+        if not new:
+            return clusters
+
+        #the known ads sharing a band with the new ads
+        bands = tuple(set(band for values, fingerprint in new for band in fingerprint))
+        candidates = {}
+        if bands:
+            cursor.execute(
+                """SELECT lsh.band, results.cluster_id, results.cp, results.nbPiece_num,
+                          results.prix_num, results.surface_num,
+                          results.latitude_num, results.longitude_num FROM lsh
+                   JOIN results ON results.cluster_id = lsh.cluster_id
+                   WHERE lsh.band IN (""" + ','.join(itertools.repeat('?', len(bands))) + ")",
+                bands
+                )
+            for row in cursor.fetchall():
+                candidates.setdefault(row[0], []).append((row[1], row[2:]))
+
+        lsh_rows = []
+        for values, fingerprint in new:
+            key = (values['cp'], self._to_int(values['nbPiece']),
+                    self._to_float(values['prix']), self._to_float(values['surface']),
+                    self._to_float(values['latitude']), self._to_float(values['longitude']))
+            cluster_id = None
+            for band in fingerprint:
+                for other_cluster, other in candidates.get(band, ()):
+                    if self._same_flat(key, other):
+                        cluster_id = other_cluster
+                        break
+                if cluster_id is not None:
+                    break
+            if cluster_id is None:
+                cluster_id = values['idAnnonce']
+            clusters[values['idAnnonce']] = cluster_id
+            #the next ads of the page can join this cluster too
+            for band in fingerprint:
+                candidates.setdefault(band, []).append((cluster_id, key))
+                lsh_rows.append((band, cluster_id))
+        cursor.executemany("INSERT INTO lsh VALUES (?, ?)", lsh_rows)
+        return clusters
+
+    def _mapped_clusters(self, cursor, clusters):
+        """
+        function returning the ads already mapped for each owner and
+        cluster (dictionnary (owner, cluster) -> set of ad ids)
+        arg 1: the cursor
+        arg 2: the clusters
+        """
+        mapped = {}
+        if not clusters:
+            return mapped
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        clusters = tuple(clusters)
+        cursor.execute(
+            """SELECT map.owner_id, results.cluster_id, map.idAnnonce FROM map
+               JOIN results ON results.idAnnonce = map.idAnnonce
+               WHERE results.cluster_id IN (""" + \
+            ','.join(itertools.repeat('?', len(clusters))) + ")",
+            clusters
+            )
+        for owner_id, cluster_id, annonce_id in cursor.fetchall():
+            mapped.setdefault((owner_id, cluster_id), set()).add(annonce_id)
+        return mapped
 
-                #inserting the new ad inside map
-                cursor.execute("INSERT INTO map VALUES (?,?,?,?,?)",\
-                        (uniq_id, annonce_id, '1', ad_type, owner_id))
-                db.commit()
+    def _getIndex(self):
+        """this function returns the index of the active searches,
+        it loads it from the database at the first call
+        no argument.
+        """
+        if self.index is not None:
+            return self.index
+        with self.index_lock:
+            if self.index is None:
+                cursor = self._getDb().cursor()
+                cursor.row_factory = self._dict_factory
+                cursor.execute("SELECT * FROM searches WHERE flag_active = 1")
+                self.index = SearchIndex(cursor.fetchall())
+        return self.index
+
+    def _getKnown(self):
+        """this function returns the ads and (owner, ad) pairs already
+        known, it loads them from the database at the first call
+        no argument.
+        """
+        if self.known is not None:
+            return self.known
+        with self.known_lock:
+            if self.known is None:
+                cursor = self._getDb().cursor()
+                cursor.row_factory = None
+                cursor.execute("SELECT idAnnonce FROM results")
+                ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute("SELECT owner_id, idAnnonce FROM map")
+                known = KnownAds(ids, cursor.fetchall())
+                ads, pairs, memory = known.size()
+                self.log.info('%d known ads and %d mappings loaded (%.1f MB)',
+                        ads, pairs, memory / 1048576.0)
+                self.known = known
+        return self.known
+
+    def _matching(self, values, ad_type):
+        """
+        function returning the active searches an ad matches
+        (whatever query fetched it)
+        arg 1: the values of the ad
+        arg 2: the type of the ad
+        """
+        candidates = self._getIndex().candidates(values['cp'], ad_type,
+            self._to_float(values['prix']), self._to_float(values['surface']),
+            self._to_int(values['nbPiece']))
+        return [search for search in candidates if self._match_search(search, values)]
 
-        #if there is another page, we return it, we return None otherwise
-        if tree.xpath('//recherche/pageSuivante'):
-            return  tree.xpath('//recherche/pageSuivante')[0].text
-        else:
-            return None
+    def _get(self, ads, ad_type):
+        """
+        function putting the ads of one xml page
+        inside the database
+        arg 1: the ads of the page (not ignored, see _excluded)
+        arg 2: the type of the ad
+        """
+        db = self._getDb()
+        cursor = db.cursor()
 
-    def _get_date(self, ad):
+        #the rows are inserted by batch, in one transaction per page
+        results_rows = []
+        map_rows = []
+        #the pruning can't remove known ads between the check and the insert
+        with self.known_lock:
+            #we skip the known ads, and the owners they are known for
+            known = self._getKnown()
+            todo = []
+            for values in ads:
+                annonce_id = values['idAnnonce']
+                searches = self._matching(values, ad_type)
+                new_searches = [search for search in searches
+                        if not known.has_pair(search['owner_id'], annonce_id)]
+                self.skipped_mappings += len(searches) - len(new_searches)
+                if known.has_ad(annonce_id):
+                    self.skipped_ads += 1
+                    if not new_searches:
+                        continue
+                    todo.append((values, True, new_searches))
+                else:
+                    todo.append((values, False, new_searches))
+            ads = [values for values, is_known, searches in todo]
+            #the same flat listed by several agencies is sent only once
+            clusters = self._clusters(cursor, ads)
+            mapped = self._mapped_clusters(cursor, set(clusters.values()))
+            for values, is_known, searches in todo:
+                # inserting the ad information inside the table
+                annonce_id = values['idAnnonce']
+                cluster_id = clusters[annonce_id]
+                if not is_known:
+                    results_rows.append(tuple(values[val] for val in self.val_xml) \
+                            + self._typed_values('results', values) + (cluster_id, ))
+
+                #we map the ad to every owner whose search matches it
+                map_rows.extend(self._mappings(values, cluster_id, searches, ad_type, mapped))
+
+            #inserting the new ads inside results and map
+            columns = self.val_xml + self._typed_names('results') + ('cluster_id', )
+            cursor.executemany(
+                    "INSERT INTO results (" + ','.join(columns) + ") VALUES (" + \
+                    ','.join(itertools.repeat('?', len(columns))) + ")",
+                    results_rows
+                    )
+            #the positions of the new ads go in the spatial index
+            if ads:
+                ids = tuple(values['idAnnonce'] for values in ads)
+                self._index_positions(cursor,
+                    "idAnnonce IN (" + ','.join(itertools.repeat('?', len(ids))) + ")", ids)
+            new_mappings = self._insert_map(cursor, map_rows)
+            db.commit()
+            #the pairs not mapped (same flat) are known too
+            known.add([values['idAnnonce'] for values in ads],
+                    [(search['owner_id'], values['idAnnonce'])
+                     for values, is_known, searches in todo for search in searches])
+            #we return the number of new mappings
+            return new_mappings
+
+    def _mappings(self, values, cluster_id, searches, ad_type, mapped):
         """
-        function getting the creation date of an ad
-        arg 1: ad
+        function returning the rows of map of an ad for the searches
+        it matches
+        arg 1: the values of the ad
+        arg 2: the cluster of the ad
+        arg 3: the searches the ad matches (see _match_search)
+        arg 4: the type of the ad
+        arg 5: the ads already mapped by owner and cluster (updated)
         """
-        return ad['dtCreation']
+        map_rows = []
+        annonce_id = values['idAnnonce']
+        for search in searches:
+            owner_id = search['owner_id']
+
+            #the owner already has an ad of the same flat
+            annonces = mapped.setdefault((owner_id, cluster_id), set())
+            if annonces and annonce_id not in annonces:
+                continue
+            annonces.add(annonce_id)
+
+            #calcul of the uniq id for the mapping between 
+            #the searcher and the ad
+            uniq_id = md5((owner_id + annonce_id).encode('utf-8')).hexdigest()
+
+            map_rows.append((uniq_id, annonce_id, '1', ad_type, owner_id))
+        return map_rows
 
+    def _insert_map(self, cursor, map_rows):
+        """
+        function inserting rows in map and adding the new ones to the stats,
+        returns the number of new mappings, it doesn't commit
+        arg 1: the cursor
+        arg 2: the rows
+        """
+        #we keep the mappings which are not already there for the stats
+        new_mappings = self._new_mappings(cursor, [row[0] for row in map_rows])
+        cursor.executemany(
+            """INSERT INTO map (uniq_id, idAnnonce, flag_shown, ad_type, owner_id)
+               VALUES (?,?,?,?,?)""",
+            map_rows
+            )
+        if new_mappings:
+            self._update_stats(cursor,
+                "map.uniq_id IN (" + ','.join(itertools.repeat('?', len(new_mappings))) + ")",
+                tuple(new_mappings)
+                )
+        return len(new_mappings)
+
+    def _new_mappings(self, cursor, uniq_ids):
+        """
+        function returning the mappings (uniq ids) not already
+        inside the map table
+        arg 1: the cursor
+        arg 2: the uniq ids of the mappings
+        """
+        if not uniq_ids:
+            return set()
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT uniq_id FROM map WHERE uniq_id IN (" + \
+            ','.join(itertools.repeat('?', len(uniq_ids))) + ")",
+            tuple(uniq_ids)
+            )
+        return set(uniq_ids) - set(row[0] for row in cursor.fetchall())
 
-    def add_search(self, owner_id, cp, min_surf, max_price, ad_type, nb_pieces_min):
+    def add_search(self, owner_id, cp, min_surf, max_price, ad_type, nb_pieces_min,
+            area=None):
         """this function adds a search inside the database
         arg 1: te owner_id of the new search
-        arg 2: the postal code of the new search
+        arg 2: the postal code of the new search (for a geographic search,
+               the postal codes covering its area, comma separated)
         arg 3: the minimal surface
         arg 4: the maximum price
         arg 4: the minimum number of room
+        arg 5: the area of a geographic search (optional)
         """
         owner_id.lower() 
         db = self._getDb()
         cursor = db.cursor()
         
         #calcul of a unique ID
-        search_id = md5((owner_id + cp + min_surf + max_price + ad_type + nb_pieces_min).encode('utf-8')).hexdigest()
+        geo = cps = None
+        if area is not None:
+            geo = str(area)
+            self.areas[geo] = area
+            cps = cp
+            cp = cps.split(',')[0]
+        search_id = md5((owner_id + (cps or cp) + min_surf + max_price + ad_type + nb_pieces_min
+            + (geo or '')).encode('utf-8')).hexdigest()
 
         #insertion of the new search parameters
-        cursor.execute("INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (search_id, owner_id, '1', cp, min_surf, max_price, ad_type, nb_pieces_min)
+        values = {
+            'min_surf': min_surf,
+            'max_price': max_price,
+            'nb_pieces': nb_pieces_min,
+            }
+        columns = ('search_id', 'owner_id', 'flag_active', 'cp', 'min_surf',
+                'max_price', 'ad_type', 'nb_pieces', 'cps', 'geo') + self._typed_names('searches')
+        cursor.execute(
+            "INSERT INTO searches (" + ','.join(columns) + ") VALUES (" + \
+            ','.join(itertools.repeat('?', len(columns))) + ")",
+            (search_id, owner_id, '1', cp, min_surf, max_price, ad_type, nb_pieces_min,
+             cps, geo) + self._typed_values('searches', values)
             )
+        values.update(search_id=search_id, owner_id=owner_id, ad_type=ad_type,
+                cp=cp, cps=cps, geo=geo)
+        #the ads already known inside the area are mapped at once
+        if area is not None:
+            self._map_area(cursor, values)
 
         db.commit()
+        self._getIndex().add(values)
 
         self.log.info('%s has added a new search', owner_id)
         return search_id
 
-    def do_searches(self):
+    def _map_area(self, cursor, search):
+        """this function maps the known ads inside the area of a
+        geographic search, found with the spatial index, it doesn't commit
+        arg 1: the cursor
+        arg 2: the search
+        """
+        self._set_cutoff()
+        cps = search['cps'].split(',')
+        min_lat, max_lat, min_lon, max_lon = self._area(search['geo']).bbox
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = self._ad_factory
+        cursor.execute(
+            "SELECT " + self.ad_select + """, NULL, NULL FROM results_geo
+               JOIN results ON results.rowid = results_geo.id
+               WHERE results_geo.max_lat >= (?) AND results_geo.min_lat <= (?)
+               AND results_geo.max_lon >= (?) AND results_geo.min_lon <= (?)
+               AND results.idTypeTransaction = (?)
+               AND results.cp IN (""" + ','.join(itertools.repeat('?', len(cps))) + ")",
+            (min_lat, max_lat, min_lon, max_lon, search['ad_type']) + tuple(cps)
+            )
+        #the bounding box of the area is wider than the area itself
+        ads = [values for values in cursor.fetchall()
+                if not self._excluded(values) and self._match_search(search, values)]
+        mapped = self._mapped_clusters(cursor, set(values['cluster_id'] for values in ads))
+        map_rows = []
+        for values in ads:
+            map_rows.extend(self._mappings(values, values['cluster_id'], (search, ),
+                search['ad_type'], mapped))
+        self._insert_map(cursor, map_rows)
+        self.log.info('%d known ads inside the area of %s', len(map_rows), search['search_id'])
+
+    def do_searches(self, on_query_done=None):
         """This function plays the searches of every user,
         and puts the infos inside the database.
-        no argument
+        arg 1: a function called with each query once all its pages
+               are stored (optional)
         """
         self.log.info('begin refreshing database')
+        self._set_cutoff()
+        self.skipped_ads = self.skipped_mappings = 0
         db = self._getDb()
         db.row_factory = self._dict_factory
         cursor = db.cursor()
         #we select all the active searches
         cursor.execute("SELECT * FROM searches WHERE flag_active = 1")
 
-        #for each searches we query seloger.com
-        for row in cursor.fetchall():
-            self._search_seloger(
-                row['cp'],row['min_surf'],row['max_price'],row['ad_type'],row['owner_id'],row['nb_pieces']
+        #we group the searches sharing the same upstream query
+        plan = self._plan_searches(self._expand_searches(cursor.fetchall()))
+
+        now = int(time.time())
+        for group in plan:
+            group['url'] = self._search_url(
+                group['cp'], group['min_surf'], group['max_price'],
+                group['ad_type'], group['nb_pieces']
+                )
+            group['signature'] = tuple(sorted(search['search_id'] for search in group['searches']))
+        self._load_state(plan, now)
+        #we only play the queries due for a poll, the most late first
+        due = self._due_queries(plan, now)
+
+        #the pages are downloaded by a pool of workers, but they are
+        #parsed and written to the database only by this thread
+        pool = self._getPool()
+        pending = {}
+        try:
+            #for each distinct query we query seloger.com once
+            for group in due:
+                group['pages'] = 1
+                pending[pool.submit(self._fetch, group['url'])] = (group['url'], group)
+
+            while pending:
+                done, not_done = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                for future in done:
+                    url, group = pending.pop(future)
+                    self._get_page(pool, pending, url, group, future.result())
+                    #one less page in progress for this query
+                    group['pages'] -= 1
+                    if group['pages'] == 0 and on_query_done is not None:
+                        on_query_done(group)
+        finally:
+            #if something went wrong, we don't download the remaining pages
+            for future in pending:
+                future.cancel()
+        self._save_state(due, now)
+        self.log.info('end refreshing database (%d/%d queries)', len(due), len(plan))
+        self.log.info('%d known ads and %d known mappings skipped',
+                self.skipped_ads, self.skipped_mappings)
+
+    def _due_queries(self, plan, now):
+        """this function returns the queries to poll now: the queries whose
+        next poll is past, the most late first, within the request budget
+        arg 1: the planned queries
+        arg 2: the date of the refresh (timestamp)
+        """
+        due = []
+        late = sorted((group for group in plan if group['next_poll'] <= now),
+                key=lambda group: group['next_poll'])
+        for group in late:
+            if not self.budget.acquire():
+                #the others wait for the next refresh
+                self.log.info('request budget exhausted, %d queries delayed',
+                        len(late) - len(due))
+                break
+            due.append(group)
+        return due
+
+    def _get_page(self, pool, pending, url, group, result):
+        """this function handles a downloaded page of a query: it asks for
+        the next page if needed and stores the ads of the page
+        arg 1: the pool of workers
+        arg 2: the pages in progress
+        arg 3: the url of the page
+        arg 4: the query
+        arg 5: the result of the download
+        """
+        if result is None:
+            group['complete'] = False
+            return
+        data, changed = result
+        link = self.page_links.get(url)
+        if not changed and link is not None and link[0] == group['signature']:
+            #the page didn't change since we read it for the
+            #same searches, its ads are known and older than the
+            #mark, we stop here unless it's time for a full sweep
+            next_url = link[1]
+            if next_url is not None and group['sweep']:
+                group['pages'] += 1
+                self.budget.reserve()
+                pending[pool.submit(self._fetch, next_url)] = (next_url, group)
+            return
+        page = self._parse(url, data)
+        if page is None:
+            return
+        ads, next_url = page
+        self.page_links[url] = (group['signature'], next_url)
+        #the ignored ads (too old, excluded...) are never stored
+        kept = [values for values in ads if not self._excluded(values)]
+        #we ask for the next page before storing this one,
+        #unless this page only contains known and old ads
+        known = self._known_page(ads, kept, group)
+        if next_url is not None and (group['sweep'] or not known):
+            group['pages'] += 1
+            self.budget.reserve()
+            pending[pool.submit(self._fetch, next_url)] = (next_url, group)
+        group['new'] += self._get(kept, group['ad_type'])
+
+    def _load_state(self, plan, now):
+        """this function loads the state of the upstream queries
+        (the high-water mark, if it's time for a full sweep and
+        when to poll it)
+        arg 1: the planned queries
+        arg 2: the date of the refresh (timestamp)
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        for group in plan:
+            cursor.execute(
+                """SELECT hwm, last_sweep, signature, interval, next_poll
+                   FROM search_state WHERE url = (?)""",
+                (group['url'], )
+                )
+            row = cursor.fetchone()
+            if row is None:
+                row = (None, None, None, None, None)
+            group['hwm'], group['last_sweep'], signature, interval, next_poll = row
+            group['sweep'] = group['hwm'] is None or group['last_sweep'] is None \
+                    or now - group['last_sweep'] >= self.sweep_interval
+            group['max_ts'] = group['hwm']
+            group['complete'] = True
+            group['new'] = 0
+            group['interval'] = interval or self.poll_interval
+            #a query never polled, or polled for other searches, is due now,
+            #and fully swept (the searches which joined it get its older pages)
+            if signature != self._signature(group):
+                next_poll = 0
+                group['sweep'] = True
+            elif next_poll is None:
+                next_poll = 0
+            group['next_poll'] = next_poll
+
+    def _save_state(self, plan, now):
+        """this function saves the state of the upstream queries
+        arg 1: the planned queries
+        arg 2: the date of the refresh (timestamp)
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        for group in plan:
+            last_sweep = group['last_sweep']
+            if group['sweep'] and group['complete']:
+                last_sweep = now
+            rate = self._arrival_rate(cursor, group, now)
+            interval = self._poll_interval(group, rate)
+            cursor.execute(
+                """INSERT OR REPLACE INTO search_state
+                   (url, hwm, last_sweep, signature, rate, interval, next_poll)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (group['url'], group['max_ts'], last_sweep, self._signature(group),
+                 rate, interval, now + interval)
+                )
+        db.commit()
+
+    def _signature(self, group):
+        """this function returns the ids of the searches of a query (as a string)
+        arg 1: the query
+        """
+        return ','.join(group['signature'])
+
+    def _arrival_rate(self, cursor, group, now):
+        """this function returns the number of new ads per hour of a query,
+        computed from the creation dates of its ads over rate_period
+        arg 1: the cursor
+        arg 2: the query
+        arg 3: the date of the refresh (timestamp)
+        """
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            """SELECT COUNT(DISTINCT results.idAnnonce) FROM results
+               JOIN map ON map.idAnnonce = results.idAnnonce
+               WHERE results.cp = (?) AND map.ad_type = (?)
+               AND results.dtCreation_ts >= (?)""",
+            (group['cp'], group['ad_type'], now - self.rate_period)
+            )
+        return cursor.fetchone()[0] * 3600.0 / self.rate_period
+
+    def _poll_interval(self, group, rate):
+        """this function returns the time (in seconds) before the next poll
+        of a query
+        arg 1: the query
+        arg 2: the number of new ads per hour of the query
+        """
+        #if a download failed, we keep the same interval
+        if not group['complete']:
+            return group['interval']
+        #the interval giving poll_ads new ads per poll
+        if rate > 0:
+            interval = 3600 * self.poll_ads / rate
+        else:
+            interval = self.poll_ceiling
+        #nothing new, we back off exponentially
+        if group['new'] == 0:
+            interval = max(interval, group['interval'] * 2)
+        return int(min(self.poll_ceiling, max(self.poll_floor, interval)))
+
+    def _known_page(self, ads, kept, group):
+        """this function returns True if all the ads of a page are older
+        than the high-water mark of the query and already in the database
+        (or ignored), the mark is raised with the ads of the page
+        arg 1: the ads of the page
+        arg 2: the ads of the page which are not ignored
+        arg 3: the query
+        """
+        known = True
+        for values in ads:
+            ts = self._to_timestamp(values['dtCreation'])
+            if ts is None or group['hwm'] is None or ts > group['hwm']:
+                known = False
+            if ts is not None and (group['max_ts'] is None or ts > group['max_ts']):
+                group['max_ts'] = ts
+        ids = [values['idAnnonce'] for values in kept]
+        if not known or not ids:
+            return known
+        #the known ads are exactly the ones in results
+        has_ad = self._getKnown().has_ad
+        return all(has_ad(annonce_id) for annonce_id in ids)
+
+    def disable_search(self, search_id, owner_id):
+        """ this function disable a search
+        arg 1: the unique id of the search
+        agr 2: the owner_id of the search
+        """
+        self.log.info('disabling search %s',search_id)
+        db = self._getDb()
+        db.row_factory = self._dict_factory
+        cursor = db.cursor()
+        with self.known_lock:
+            #we delete the given search of the given user
+            cursor.execute(
+                "DELETE FROM searches WHERE search_id = (?) AND owner_id = (?)",
+                (search_id, owner_id)
+                )
+            deleted = cursor.rowcount > 0
+            #we remove the ads of the user which no active search covers anymore
+            pairs = self._delete_map(cursor,
+                    self.orphan_where + " AND map.owner_id = (?)", (owner_id, ))
+            db.commit()
+            #the deleted mappings are not known anymore
+            self._getKnown().remove((), pairs)
+        if deleted:
+            self._getIndex().remove(search_id)
+        self.log.info('%s has deleted search %s', owner_id, search_id)
+
+    def get_search(self, owner_id):
+        """ this function returns the search of a given user
+        arg 1: the owner_id
+        """
+        self.log.info('printing search list of %s', owner_id)
+        owner_id.lower() 
+        db = self._getDb()
+        db.row_factory = self._dict_factory
+        cursor = db.cursor()
+        #we get all the searches of the given user
+        cursor.execute(
+            "SELECT * FROM searches WHERE owner_id = (?) AND flag_active = 1",
+            (owner_id, )
+            )
+        self.log.info('%s has queried his searches', owner_id)
+
+        return cursor.fetchall()
+
+    def get_new(self):
+        """ this function returns the ads not already delivered (pending
+        or failed) and marks them as "in-flight", they are marked as
+        delivered once the messages queued for them are sent.
+        no argument
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._ad_factory
+        #we claim all the new ads with the name of their owner
+        #in one transaction, the failed ones once their delay is over
+        claimed = "map.flag_shown = (?) OR (map.flag_shown = (?) AND COALESCE(map.retry_at, 0) <= (?))"
+        params = (self.PENDING, self.FAILED, int(time.time()))
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                "SELECT " + self.ad_select + """, map.owner_id, map.uniq_id FROM map
+                   JOIN results ON results.idAnnonce = map.idAnnonce
+                   WHERE """ + claimed + " ORDER BY results.dtCreation",
+                params
+                )
+            return_annonces = cursor.fetchall()
+            cursor.execute(
+                "UPDATE map SET flag_shown = (?) WHERE " + claimed,
+                (self.IN_FLIGHT, ) + params
+                )
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        #we get the number of new ads
+        number_of_new_ads = str(len(return_annonces))
+        self.log.info('printing %s new ads', number_of_new_ads)
+        #we return the ads
+        return return_annonces
+
+    def release_deliveries(self, uniq_ids):
+        """ this function gives back the ads claimed by get_new which
+        couldn't be queued, they are delivered again by the next get_new
+        arg1: the uniq ids of the ads
+        """
+        if not uniq_ids:
+            return
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.execute(
+            "UPDATE map SET flag_shown = (?) WHERE flag_shown = (?) AND uniq_id IN (" + \
+            ','.join(itertools.repeat('?', len(uniq_ids))) + ")",
+            (self.PENDING, self.IN_FLIGHT) + tuple(uniq_ids)
+            )
+        db.commit()
+
+    def fail_deliveries(self, uniq_ids):
+        """ this function marks as failed the ads claimed by get_new which
+        couldn't be delivered (see _fail_ads)
+        arg1: the uniq ids of the ads
+        """
+        if not uniq_ids:
+            return
+        db = self._getDb()
+        cursor = db.cursor()
+        self._fail_ads(cursor,
+            "flag_shown = (?) AND uniq_id IN (" + \
+            ','.join(itertools.repeat('?', len(uniq_ids))) + ")",
+            (self.IN_FLIGHT, ) + tuple(uniq_ids)
+            )
+        db.commit()
+
+    def _fail_ads(self, cursor, where, params):
+        """ this function counts a failed delivery for the ads matching a
+        filter: they are claimed again by get_new after a delay (doubled at
+        each failure), and dropped after max_failures, it doesn't commit
+        arg1: the cursor
+        arg2: the filter on map
+        arg3: the parameters of the filter
+        """
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT COUNT(*) FROM map WHERE COALESCE(failures, 0) + 1 >= (?) AND " + where,
+            (self.max_failures, ) + params
+            )
+        dropped = cursor.fetchone()[0]
+        cursor.execute(
+            """UPDATE map SET failures = COALESCE(failures, 0) + 1,
+               flag_shown = CASE WHEN COALESCE(failures, 0) + 1 >= (?) THEN (?) ELSE (?) END,
+               retry_at = (?) + ((?) << COALESCE(failures, 0))
+               WHERE """ + where,
+            (self.max_failures, self.DROPPED, self.FAILED, int(time.time()),
+             self.failure_delay) + params
+            )
+        if dropped:
+            self.log.warning('%d ads failed %d times, they are dropped',
+                    dropped, self.max_failures)
+
+    def recover_deliveries(self):
+        """ this function puts back as pending the ads claimed by get_new
+        but never queued (after a crash), the ads already queued
+        stay in the outbox, so nothing is sent twice.
+        no argument
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.execute(
+            """UPDATE map SET flag_shown = (?)
+               WHERE flag_shown = (?)
+               AND uniq_id NOT IN (SELECT uniq_id FROM outbox_ads)""",
+            (self.PENDING, self.IN_FLIGHT)
+            )
+        db.commit()
+        if cursor.rowcount > 0:
+            self.log.info('%d ads to deliver again', cursor.rowcount)
+
+    def get_all(self, owner_id, pc='all', ad_type='1'):
+        """ this function returns all the ads of a given user and postal code
+        arg1: the owner id
+        arg2: the postal code
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._ad_factory
+        #we get all the ads of a given user
+        #(with a filter on the postal code if we don't query all the ads)
+        where, params = self._ads_where(owner_id, pc, ad_type)
+        cursor.execute(
+            "SELECT " + self.ad_select + """, map.owner_id, map.uniq_id FROM map
+             JOIN results ON results.idAnnonce = map.idAnnonce WHERE """ + where,
+            params
+            )
+        return_annonces = cursor.fetchall()
+
+        #we get the number of ads
+        number_of_ads = str(len(return_annonces))
+        self.log.info('getting %s ads', number_of_ads)
+        #we return the ads
+        return return_annonces
+
+    def _ads_where(self, owner_id, pc, ad_type):
+        """this function returns the filter (and its parameters) on map
+        and results of the ads of a given user and postal code
+        arg1: the owner id
+        arg2: the postal code ('all' for no filter)
+        arg3: the type of the ads
+        """
+        where = "map.owner_id = (?) AND map.ad_type = (?)"
+        params = (owner_id, ad_type)
+        if pc != 'all':
+            where += " AND results.cp = (?)"
+            params += (pc, )
+        return where, params
+
+    def get_market_columns(self, pc='all', ad_type='1', days=90,
+            fields=('prix_num', 'surface_num', 'nbPiece_num', 'dtCreation_ts')):
+        """ this function returns the numeric fields of all the ads (of every
+        user) of a postal code created in the last days, by column: a
+        dictionnary field -> numpy array if numpy is installed, array('d')
+        otherwise (NaN when unknown), each flat listed by several agencies
+        counts once.
+        The ads are the ones fetched for the searches (the upstream queries
+        are filtered by their criteria), the ones mapped to nobody are only
+        kept market_window days (see _prune_results).
+        arg1: the postal code ('all' for no filter)
+        arg2: the type of the ads
+        arg3: the number of days
+        arg4: the fields (converted at ingest)
+        """
+        where = """results.dtCreation_ts >= (?) AND results.idTypeTransaction = (?)
+                   AND results.cluster_id = results.idAnnonce"""
+        params = (int(time.time()) - days * 86400, ad_type)
+        if pc != 'all':
+            where += " AND results.cp = (?)"
+            params += (pc, )
+        return self._columns(fields, "FROM results WHERE " + where, params)
+
+    def _columns(self, fields, query, params):
+        """ this function returns the fields of the rows of a query by
+        column (numpy arrays if numpy is installed, array('d') otherwise)
+        arg1: the fields
+        arg2: the query, without the SELECT part
+        arg3: the parameters of the query
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        for field in fields:
+            if field not in Ad._fields:
+                raise ValueError('unknown field %s' % field)
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT " + ', '.join('results.' + field for field in fields) + " " + query,
+            params
+            )
+        nan = float('nan')
+        rows = cursor.fetchall()
+        columns = []
+        #the rows are transposed at once, the missing values become nan
+        for values in zip(*rows) if rows else [() for field in fields]:
+            try:
+                columns.append(array.array('d', values))
+            except TypeError:
+                columns.append(array.array('d', (nan if value is None else value
+                    for value in values)))
+        if numpy is not None:
+            columns = [numpy.frombuffer(column, dtype=numpy.float64) for column in columns]
+        return dict(zip(fields, columns))
+
+    def enqueue_messages(self, messages):
+        """ this function queues messages to send to slack
+        arg1: the messages, a list of (channel, text, uniq ids of the ads
+              delivered by the message)
+        """
+        if not messages:
+            return
+        now = int(time.time())
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        #we allocate the ids of the messages ourselves, so the whole batch
+        #is inserted with two statements
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'outbox'")
+            row = cursor.fetchone()
+            first = (row[0] if row is not None else 0) + 1
+            cursor.executemany(
+                """INSERT INTO outbox (msg_id, channel, text, created, attempts, next_try)
+                   VALUES (?, ?, ?, ?, 0, ?)""",
+                [(first + i, channel, text, now, now)
+                    for i, (channel, text, uniq_ids) in enumerate(messages)]
+                )
+            cursor.executemany(
+                "INSERT INTO outbox_ads VALUES (?, ?)",
+                [(first + i, uniq_id)
+                    for i, (channel, text, uniq_ids) in enumerate(messages)
+                    for uniq_id in uniq_ids]
+                )
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    def get_outbox(self, limit=100):
+        """ this function returns the messages which can be sent now,
+        oldest first, as a list of (msg_id, channel, text, attempts)
+        arg1: the maximum number of messages
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            """SELECT msg_id, channel, text, attempts FROM outbox
+               WHERE next_try <= (?) ORDER BY msg_id LIMIT (?)""",
+            (int(time.time()), limit)
+            )
+        return cursor.fetchall()
+
+    def _close_messages(self, msg_ids, state):
+        """ this function removes messages from the queue, and sets the
+        delivery state of their ads
+        arg1: the ids of the messages
+        arg2: the new delivery state of the ads
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        ids = ','.join(itertools.repeat('?', len(msg_ids)))
+        where = "uniq_id IN (SELECT uniq_id FROM outbox_ads WHERE msg_id IN (" + ids + "))"
+        if state == self.FAILED:
+            self._fail_ads(cursor, where, tuple(msg_ids))
+        else:
+            cursor.execute(
+                "UPDATE map SET flag_shown = (?) WHERE " + where,
+                (state, ) + tuple(msg_ids)
+                )
+        cursor.execute("DELETE FROM outbox_ads WHERE msg_id IN (" + ids + ")",
+                tuple(msg_ids))
+        cursor.execute("DELETE FROM outbox WHERE msg_id IN (" + ids + ")",
+                tuple(msg_ids))
+        db.commit()
+
+    def ack_messages(self, msg_ids):
+        """ this function removes messages sent to slack from the queue,
+        their ads are marked as delivered
+        arg1: the ids of the messages
+        """
+        self._close_messages(msg_ids, self.DELIVERED)
+
+    def fail_messages(self, msg_ids):
+        """ this function removes messages which could not be sent from
+        the queue, their ads are marked as failed (see _fail_ads)
+        arg1: the ids of the messages
+        """
+        self._close_messages(msg_ids, self.FAILED)
+
+    def retry_messages(self, msg_ids, delay):
+        """ this function postpones messages which could not be sent
+        arg1: the ids of the messages
+        arg2: the delay (in seconds) before the next attempt
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.execute(
+            "UPDATE outbox SET attempts = attempts + 1, next_try = (?) WHERE msg_id IN (" + \
+            ','.join(itertools.repeat('?', len(msg_ids))) + ")",
+            (int(time.time() + delay), ) + tuple(msg_ids)
+            )
+        db.commit()
+
+    def _stats_select(self, where, sign=1):
+        """this function returns the query computing the stats
+        of the mapped ads matching a filter, the ads without a price,
+        a surface or a number of rooms are not counted.
+        arg 1: the filter on map and results
+        arg 2: 1 to add the ads to the stats, -1 to remove them
+        """
+        return """SELECT map.owner_id, map.ad_type, results.cp,
+                         results.nbPiece_num,
+                         CAST(results.surface_num AS INTEGER),
+                         %(sign)d * COUNT(*),
+                         %(sign)d * SUM(results.prix_num),
+                         %(sign)d * SUM(results.surface_num),
+                         %(sign)d * SUM(results.prix_num / results.surface_num)
+                  FROM map JOIN results ON results.idAnnonce = map.idAnnonce
+                  WHERE (%(where)s)
+                  AND results.prix_num IS NOT NULL
+                  AND results.surface_num > 0
+                  AND results.nbPiece_num IS NOT NULL
+                  GROUP BY 1, 2, 3, 4, 5""" % {'sign': sign, 'where': where}
+
+    def _update_stats(self, cursor, where, params, sign=1):
+        """this function adds (or removes) the mapped ads
+        matching a filter to (or from) the stats, and increments the
+        versions of the stats it changes, it doesn't commit
+        arg 1: the cursor
+        arg 2: the filter on map and results
+        arg 3: the parameters of the filter
+        arg 4: 1 to add the ads to the stats, -1 to remove them
+        """
+        #a cursor of the same connexion (same transaction), reading tuples
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = None
+        #without RETURNING, the changed stats are read before
+        if not self.returning:
+            cursor.execute(
+                "SELECT DISTINCT map.owner_id, map.ad_type, results.cp FROM map " \
+                "JOIN results ON results.idAnnonce = map.idAnnonce " \
+                "WHERE (" + where + ") AND results.prix_num IS NOT NULL " \
+                "AND results.surface_num > 0 AND results.nbPiece_num IS NOT NULL",
+                params
+                )
+            keys = set(cursor.fetchall())
+        cursor.execute(
+            """INSERT INTO stats (owner_id, ad_type, cp, rooms, surface_range,
+                                  number, sum_price, sum_surface, sum_price_m2) """
+            + self._stats_select(where, sign) + """
+               ON CONFLICT (owner_id, ad_type, cp, rooms, surface_range) DO UPDATE SET
+               number = number + excluded.number,
+               sum_price = sum_price + excluded.sum_price,
+               sum_surface = sum_surface + excluded.sum_surface,
+               sum_price_m2 = sum_price_m2 + excluded.sum_price_m2"""
+            + (" RETURNING owner_id, ad_type, cp" if self.returning else ""),
+            params
+            )
+        #the versions are in the same transaction as the stats,
+        #a reader never sees the new stats with the old version
+        if self.returning:
+            keys = set(cursor.fetchall())
+        if keys:
+            cursor.executemany(
+                """INSERT INTO stats_versions VALUES (?,?,?,1)
+                   ON CONFLICT (owner_id, ad_type, cp) DO UPDATE SET
+                   version = version + 1""",
+                keys
+                )
+        if sign < 0:
+            cursor.execute("DELETE FROM stats WHERE number <= 0")
+
+    def _delete_map(self, cursor, where, params):
+        """this function deletes the mapped ads matching a filter,
+        and removes them from the stats, it doesn't commit, returns
+        the (owner id, ad id) pairs deleted
+        arg 1: the cursor
+        arg 2: the filter on map and results
+        arg 3: the parameters of the filter
+        """
+        self._update_stats(cursor, where, params, -1)
+        #a cursor of the same connexion (same transaction), reading tuples
+        reader = cursor.connection.cursor()
+        reader.row_factory = None
+        reader.execute(
+            """SELECT map.owner_id, map.idAnnonce FROM map
+               JOIN results ON results.idAnnonce = map.idAnnonce
+               WHERE """ + where,
+            params
+            )
+        pairs = reader.fetchall()
+        cursor.execute(
+            """DELETE FROM map WHERE uniq_id IN (
+               SELECT map.uniq_id FROM map
+               JOIN results ON results.idAnnonce = map.idAnnonce
+               WHERE """ + where + ")",
+            params
+            )
+        return pairs
+
+    def _rebuild_stats(self, db):
+        """this function computes again the stats from all the mapped ads
+        arg 1: the database connexion
+        """
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM stats")
+        #the stats which disappear change too
+        cursor.execute("UPDATE stats_versions SET version = version + 1")
+        self._update_stats(cursor, '1', ())
+        db.commit()
+
+    def check_stats(self, repair=False):
+        """ this function compares the stats with the ones computed
+        again from all the mapped ads, and returns the keys
+        (owner, type of ad, postal code, rooms, surface range) which differ
+        arg1: if True, the stats are computed again when they differ
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute(self._stats_select('1'))
+        expected = dict((tuple(row[:5]), row[5:]) for row in cursor.fetchall())
+        cursor.execute("""SELECT owner_id, ad_type, cp, rooms, surface_range,
+                                 number, sum_price, sum_surface, sum_price_m2
+                          FROM stats""")
+        current = dict((tuple(row[:5]), row[5:]) for row in cursor.fetchall())
+
+        errors = []
+        for key in set(expected) | set(current):
+            if key not in expected or key not in current:
+                errors.append(key)
+                continue
+            for a, b in zip(expected[key], current[key]):
+                #the sums are floats, they can drift a little
+                if abs(a - b) > 1e-6 * max(1.0, abs(a)):
+                    errors.append(key)
+                    break
+
+        if errors:
+            self.log.warning('%d stats out of sync', len(errors))
+            if repair:
+                self._rebuild_stats(db)
+        return errors
+
+    def _getArchive(self):
+        """this function returns the archive database connexion,
+        if the archive doesn't exist, it creates it.
+        no argument.
+        """
+        try:
+            import sqlite3
+        except ImportError:
+            raise Exception('You need to have sqlite3 installed to ' \
+                                   'use SeLoger.')
+        if self.archive is not None:
+            return self.archive
+        archive = sqlite3.connect(self.archive_filename, check_same_thread = False,
+                timeout = 60)
+        #idAnnonce: the id of the ad
+        #cp: the postal code
+        #dtCreation_ts: the creation date (timestamp) of the ad
+        #archived: the date (timestamp) the ad was archived
+        #data: the row of the ad in results (compressed JSON)
+        archive.execute("""CREATE TABLE IF NOT EXISTS results (
+                           idAnnonce TEXT PRIMARY KEY,
+                           cp TEXT,
+                           dtCreation_ts INTEGER,
+                           archived INTEGER,
+                           data BLOB)""")
+        archive.execute("""CREATE INDEX IF NOT EXISTS results_created
+                           ON results (dtCreation_ts)""")
+        archive.commit()
+        self.archive = archive
+        return archive
+
+    def prune(self):
+        """ this function removes the ads which are not needed anymore:
+        the mapped ads no active search covers, the mapped ads older than
+        the retention of their type, and the ads mapped to nobody
+        (archived first if there is an archive), then it compacts
+        the database if needed. Each chunk is its own transaction.
+        The ads still to deliver (pending, in flight or failed) are kept,
+        the dropped ones (failed max_failures times) are pruned like the
+        delivered ones.
+        no argument
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        now = int(time.time())
+        #the ads waiting to be sent are kept, they are pruned once sent
+        #(or dropped)
+        kept = " AND map.flag_shown NOT IN (%d, %d, %d)" % (self.PENDING,
+                self.IN_FLIGHT, self.FAILED)
+        orphans = self._prune_map(cursor, self.orphan_where + kept, ())
+        expired = 0
+        for ad_type, days in self.retention.items():
+            days = max(days, self.max_age)
+            expired += self._prune_map(cursor,
+                "map.ad_type = (?) AND results.dtCreation_ts < (?)" + kept,
+                (ad_type, now - days * 86400))
+        removed = self._prune_results(cursor, now)
+        self._prune_lsh(cursor)
+        self.log.info('pruned %d orphaned and %d expired mappings, %d ads',
+                orphans, expired, removed)
+        self._compact(db)
+
+    def _prune_map(self, cursor, where, params):
+        """this function deletes by chunks the mapped ads matching a filter,
+        returns the number of mappings deleted
+        arg 1: the cursor
+        arg 2: the filter on map and results
+        arg 3: the parameters of the filter
+        """
+        total = 0
+        while True:
+            cursor.execute(
+                """SELECT map.uniq_id FROM map
+                   JOIN results ON results.idAnnonce = map.idAnnonce
+                   WHERE """ + where + " LIMIT (?)",
+                params + (self.prune_chunk, )
+                )
+            uniq_ids = tuple(row[0] for row in cursor.fetchall())
+            if not uniq_ids:
+                return total
+            with self.known_lock:
+                pairs = self._delete_map(cursor,
+                    "map.uniq_id IN (" + ','.join(itertools.repeat('?', len(uniq_ids))) + ")",
+                    uniq_ids)
+                cursor.connection.commit()
+                #the deleted mappings are not known anymore
+                self._getKnown().remove((), pairs)
+            total += len(uniq_ids)
+            time.sleep(self.prune_pause)
+
+    def _prune_results(self, cursor, now):
+        """this function deletes by chunks the ads mapped to nobody
+        (after archiving them), returns the number of ads deleted.
+        The ads of the market window, and the first ad of a cluster
+        (its flat in the market stats) while the cluster has other ads,
+        are kept.
+        arg 1: the cursor
+        arg 2: the date of the pruning (timestamp)
+        """
+        total = 0
+        while True:
+            #the ingest can't map a selected ad before it's deleted
+            with self.known_lock:
+                cursor.execute(
+                    """SELECT * FROM results WHERE NOT EXISTS (
+                       SELECT 1 FROM map WHERE map.idAnnonce = results.idAnnonce)
+                       AND (results.dtCreation_ts IS NULL OR results.dtCreation_ts < (?))
+                       AND NOT (results.cluster_id = results.idAnnonce AND EXISTS (
+                       SELECT 1 FROM results other WHERE other.cluster_id = results.cluster_id
+                       AND other.idAnnonce != results.idAnnonce))
+                       LIMIT (?)""",
+                    (now - self.market_window * 86400, self.prune_chunk)
+                    )
+                rows = cursor.fetchall()
+                if not rows:
+                    return total
+                columns = [col[0] for col in cursor.description]
+                ids = tuple(row[columns.index('idAnnonce')] for row in rows)
+                #the ads are in the archive before being deleted
+                #(an ad can be archived twice after a crash, not lost)
+                if self.archive_filename is not None:
+                    archive = self._getArchive()
+                    archive.executemany(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                        [(ad['idAnnonce'], ad['cp'], ad['dtCreation_ts'], now,
+                          zlib.compress(json.dumps(ad).encode('utf-8')))
+                         for ad in (dict(zip(columns, row)) for row in rows)]
+                        )
+                    archive.commit()
+                placeholders = ','.join(itertools.repeat('?', len(ids)))
+                cursor.execute(
+                    """DELETE FROM results_geo WHERE id IN (
+                       SELECT rowid FROM results WHERE idAnnonce IN (""" + placeholders + "))",
+                    ids
+                    )
+                cursor.execute(
+                    "DELETE FROM results WHERE idAnnonce IN (" + placeholders + ")",
+                    ids
+                    )
+                cursor.connection.commit()
+                #the deleted ads are not known anymore
+                self._getKnown().remove(ids, ())
+            total += len(ids)
+            time.sleep(self.prune_pause)
+
+    def _prune_lsh(self, cursor):
+        """this function deletes by chunks the fingerprints of the
+        clusters without ads
+        arg 1: the cursor
+        """
+        while True:
+            cursor.execute(
+                """DELETE FROM lsh WHERE rowid IN (
+                   SELECT rowid FROM lsh WHERE NOT EXISTS (
+                   SELECT 1 FROM results WHERE results.cluster_id = lsh.cluster_id)
+                   LIMIT (?))""",
+                (self.prune_chunk, )
                 )
-        self.log.info('end refreshing database')
-
-    def disable_search(self, search_id, owner_id):
-        """ this function disable a search
-        arg 1: the unique id of the search
-        agr 2: the owner_id of the search
+            cursor.connection.commit()
+            if cursor.rowcount < self.prune_chunk:
+                return
+            time.sleep(self.prune_pause)
+
+    def _compact(self, db):
+        """this function updates the statistics of the query planner,
+        and rebuilds the database when too much of it is free pages
+        arg 1: the database connexion
         """
-        self.log.info('disabling search %s',search_id)
-        db = self._getDb()
-        db.row_factory = self._dict_factory
         cursor = db.cursor()
-        #we delete the given search of the given user
-        cursor.execute(
-            "DELETE FROM searches WHERE search_id = (?) AND owner_id = (?)",
-            (search_id, owner_id)
-            )
+        cursor.row_factory = None
+        cursor.execute("ANALYZE")
+        cursor.execute("PRAGMA page_count")
+        pages = cursor.fetchone()[0]
+        cursor.execute("PRAGMA freelist_count")
+        free = cursor.fetchone()[0]
         db.commit()
-        self.log.info('%s has deleted search %s', owner_id, search_id)
-
-    def get_search(self, owner_id):
-        """ this function returns the search of a given user
-        arg 1: the owner_id
+        if pages and free > pages * self.vacuum_ratio:
+            self.log.info('compacting the database (%d/%d free pages)', free, pages)
+            cursor.execute("VACUUM")
+            #VACUUM may renumber the rowids of results (its primary key
+            #is not an INTEGER), the spatial index is built again from them,
+            #in one transaction so the geographic searches never see it empty
+            cursor.execute("DELETE FROM results_geo")
+            self._index_positions(cursor, "1", ())
+            db.commit()
+
+    def _stats_where(self, owner_id, pc, ad_type):
+        """this function returns the filter (and its parameters) of the stats
+        of a given user and postal code.
+        arg1: the owner id
+        arg2: the postal code ('all' for no filter)
+        arg3: the type of the ads
+        """
+        where = "owner_id = (?) AND ad_type = (?)"
+        params = (owner_id, ad_type)
+        if pc != 'all':
+            where += " AND cp = (?)"
+            params += (pc, )
+        return where, params
+
+    def get_stats_version(self, owner_id, pc='all', ad_type='1'):
+        """ this function returns the version of the stats of a given user
+        and postal code, it changes each time these stats change
+        (read it before the stats)
+        arg1: the owner id
+        arg2: the postal code ('all' for no filter)
+        arg3: the type of the ads
         """
-        self.log.info('printing search list of %s', owner_id)
-        owner_id.lower() 
         db = self._getDb()
-        db.row_factory = self._dict_factory
         cursor = db.cursor()
-        #we get all the searches of the given user
+        cursor.row_factory = None
+        where, params = self._stats_where(owner_id, pc, ad_type)
+        #the versions only grow, their sum changes with any of them
+        cursor.execute("SELECT TOTAL(version) FROM stats_versions WHERE " + where, params)
+        return int(cursor.fetchone()[0])
+
+    def get_stats_rooms(self, owner_id, pc='all', ad_type='1'):
+        """ this function returns the stats by number of rooms
+        of the ads of a given user and postal code:
+        a list of (rooms, number of ads, mean surface, mean price)
+        arg1: the owner id
+        arg2: the postal code
+        arg3: the type of the ads
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = None
+        where, params = self._stats_where(owner_id, pc, ad_type)
         cursor.execute(
-            "SELECT * FROM searches WHERE owner_id = (?) AND flag_active = 1",
-            (owner_id, )
+            """SELECT rooms, SUM(number),
+                      SUM(sum_surface) / SUM(number), SUM(sum_price) / SUM(number)
+               FROM stats
+               WHERE """ + where + """
+               GROUP BY rooms
+               ORDER BY rooms""",
+            params
             )
-        self.log.info('%s has queried his searches', owner_id)
-
         return cursor.fetchall()
 
-    def get_new(self):
-        """ this function returns the ads not already printed
-        and marks them as "printed".
-        no argument
+    def get_stats_surface(self, owner_id, pc='all', ad_type='1',
+            number_of_steps=7, max_step=5):
+        """ this function returns the stats by surface range
+        of the ads of a given user and postal code:
+        the step of the ranges and a list of
+        (range, number of ads, mean price, mean price per square meter),
+        the range n goes from n * step to (n + 1) * step
+        arg1: the owner id
+        arg2: the postal code
+        arg3: the type of the ads
+        arg4: the number of steps between the min and the max surfaces
+        arg5: the maximum step
         """
         db = self._getDb()
-        db.row_factory = self._dict_factory
         cursor = db.cursor()
-        #we get all the new ads
-        cursor.execute("SELECT * FROM map WHERE flag_shown = 1")
+        cursor.row_factory = None
+        where, params = self._stats_where(owner_id, pc, ad_type)
 
-        return_annonces=[]
-        for row in cursor.fetchall():
-            uniq = row['uniq_id']
-            #we mark the ad as "read"
-            cursor.execute(
-                """UPDATE map SET flag_shown = 0 WHERE uniq_id = (?)""",
-                (uniq, )
-                )
-            #we get the infos of the ad
-            result = self._get_annonce(row['idAnnonce'])
-            #we ad in the result the name of the owner
-            result['owner_id'] = row['owner_id']
-            return_annonces.append(result)
+        #we calcul the step of the range from the min and max surfaces
+        #(rounded down to the square meter)
+        cursor.execute(
+            """SELECT MIN(surface_range), MAX(surface_range)
+               FROM stats
+               WHERE """ + where,
+            params
+            )
+        mini, maxi = cursor.fetchone()
+        if mini is None:
+            return None, []
+        step = min(max(1, int((maxi - mini) / number_of_steps)), max_step)
 
-        db.commit()
+        cursor.execute(
+            """SELECT surface_range / (?) AS step_range, SUM(number),
+                      SUM(sum_price) / SUM(number), SUM(sum_price_m2) / SUM(number)
+               FROM stats
+               WHERE """ + where + """
+               GROUP BY step_range
+               ORDER BY step_range""",
+            (step, ) + params
+            )
+        return step, cursor.fetchall()
 
-        #we sort the ads by date
-        return_annonces.sort(key=self._get_date)
-        #we get the number of new ads
-        number_of_new_ads = str(len(return_annonces))
-        self.log.info('printing %s new ads', number_of_new_ads)
-        #we return the ads
-        return return_annonces
 
-    def get_all(self, owner_id, pc='all', ad_type='1'):
-        """ this function returns all the ads of a given user and postal code
-        arg1: the owner id
-        arg2: the postal code
+class StatsEngine(object):
+    """This Class computes the stats of the prices of ads given by column
+    (see get_market_columns): the quantiles of the price and of the price per
+    square meter, overall, by number of rooms, by surface range and by week.
+    It uses numpy when it's installed, plain python otherwise (both
+    interpolate the quantiles the same way).
+    """
+
+    def __init__(self, surface_step=10, surface_max=150, use_numpy=True):
+        #the surface ranges: surface_step square meters, up to surface_max
+        self.surface_step = surface_step
+        self.surface_max = surface_max
+        self.numpy = None
+        if use_numpy:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                pass
+
+    def compute(self, columns):
+        """returns the stats of ads (dictionnary):
+        'count', 'price' and 'price_m2' (count, mean, p10, median, p90)
+        and 'rooms', 'surface', 'weeks' (lists of (key, stats of the price
+        per square meter) sorted by key)
+        arg 1: the columns prix_num, surface_num, nbPiece_num, dtCreation_ts
         """
-        db = self._getDb()
-        db.row_factory = self._dict_factory
-        cursor = db.cursor()
-        #we get all the ads of a given user
-        cursor.execute("SELECT * FROM map WHERE owner_id = (?) AND ad_type = (?)",
-                (owner_id, ad_type)
-                )
+        if self.numpy is not None:
+            return self._compute_numpy(columns)
+        return self._compute_python(columns)
 
-        return_annonces=[]
-        for row in cursor.fetchall():
-            uniq = row['uniq_id']
+    @staticmethod
+    def _quantile(values, q):
+        #values is sorted, linear interpolation (like numpy)
+        position = (len(values) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    def _summary(self, values):
+        values.sort()
+        if not values:
+            return None
+        return (len(values), sum(values) / len(values), self._quantile(values, 0.1),
+                self._quantile(values, 0.5), self._quantile(values, 0.9))
+
+    def _compute_python(self, columns):
+        prices = []
+        prices_m2 = []
+        rooms = {}
+        surfaces = {}
+        #the weeks start on monday (the epoch is a thursday)
+        weeks = {}
+        #one pass over the ads, the values are dispatched in their groups
+        for price, surface, room, date in zip(columns['prix_num'],
+                columns['surface_num'], columns['nbPiece_num'], columns['dtCreation_ts']):
+            if price != price:
+                continue
+            prices.append(price)
+            if surface != surface or surface <= 0:
+                continue
+            price_m2 = price / surface
+            prices_m2.append(price_m2)
+            if room == room:
+                rooms.setdefault(int(room), []).append(price_m2)
+            surfaces.setdefault(self._surface_range(surface), []).append(price_m2)
+            if date == date:
+                weeks.setdefault((int(date) + 259200) // 604800, []).append(price_m2)
+        return {
+            'count': len(prices),
+            'price': self._summary(prices),
+            'price_m2': self._summary(prices_m2),
+            'rooms': [(key, self._summary(rooms[key])) for key in sorted(rooms)],
+            'surface': [(key, self._summary(surfaces[key])) for key in sorted(surfaces)],
+            'weeks': [(key, self._summary(weeks[key])) for key in sorted(weeks)],
+            }
+
+    def _surface_range(self, surface):
+        return min(int(surface // self.surface_step), self.surface_max // self.surface_step)
+
+    def _summary_numpy(self, values):
+        np = self.numpy
+        if not len(values):
+            return None
+        p10, median, p90 = np.percentile(values, (10, 50, 90))
+        return (len(values), float(values.mean()), float(p10), float(median), float(p90))
+
+    def _groups_numpy(self, keys, values):
+        np = self.numpy
+        #the values sorted by key, then split at each change of key
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = values[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        return [(int(group_keys[0]), self._summary_numpy(group_values))
+                for group_keys, group_values in zip(np.split(keys, bounds),
+                    np.split(values, bounds)) if len(group_keys)]
+
+    def _compute_numpy(self, columns):
+        np = self.numpy
+        price = np.asarray(columns['prix_num'], dtype=np.float64)
+        surface = np.asarray(columns['surface_num'], dtype=np.float64)
+        room = np.asarray(columns['nbPiece_num'], dtype=np.float64)
+        date = np.asarray(columns['dtCreation_ts'], dtype=np.float64)
+        known = ~np.isnan(price)
+        prices = price[known]
+        with_m2 = known & (surface > 0)
+        price_m2 = price[with_m2] / surface[with_m2]
+        room = room[with_m2]
+        date = date[with_m2]
+        surface = surface[with_m2]
+        surface_range = np.minimum(surface // self.surface_step,
+                self.surface_max // self.surface_step)
+        return {
+            'count': len(prices),
+            'price': self._summary_numpy(prices),
+            'price_m2': self._summary_numpy(price_m2),
+            'rooms': self._groups_numpy(room[~np.isnan(room)], price_m2[~np.isnan(room)]),
+            'surface': self._groups_numpy(surface_range, price_m2),
+            'weeks': self._groups_numpy((date[~np.isnan(date)] + 259200) // 604800,
+                price_m2[~np.isnan(date)]),
+            }
+
+
+class RenderCache(object):
+    """This Class keeps the last rendered stats (the messages sent to
+    slack) by key, the least recently used are removed first.
+    The keys contain the version of the stats (see get_stats_version),
+    so the renders of stats which changed are never used again.
+    """
 
-            #we get the infos of the ad
-            result = self._get_annonce(row['idAnnonce'])
-            #we ad in the result the name of the owner
-            result['owner_id'] = row['owner_id']
-            #we ad it only if we query all the ads 
-            #or it matches the postal code
-            if pc == 'all' or result['cp'] == pc:
-                return_annonces.append(result)
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-        #we get the number of ads
-        number_of_ads = str(len(return_annonces))
-        self.log.info('getting %s ads', number_of_ads)
-        #we return the ads
-        return return_annonces
+    def get(self, key):
+        """returns the render of a key, None if it's not in the cache
+        arg 1: the key
+        """
+        with self.lock:
+            render = self.entries.get(key)
+            if render is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return render
+
+    def put(self, key, render):
+        """puts the render of a key in the cache
+        arg 1: the key
+        arg 2: the render
+        """
+        with self.lock:
+            self.entries[key] = render
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
 
 class SeLoger():
@@ -438,13 +3081,35 @@ class SeLoger():
         handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(logging.DEBUG)
         self.log.addHandler(handler)
-        self.backend = SqliteSeLogerDB(self.log)
-        self.gettingLockLock = threading.Lock()
-        self.locks = {}
+        self.backend = SqliteSeLogerDB(self.log,
+                **self._load_config(os.environ.get('SELOGER_CONFIG',
+                    os.environ.get('SELOGER_EXCLUSIONS'))))
         self.sc = sc
         self.graph = Pyasciigraph()
+        self.stats_engine = StatsEngine()
+        self.render_cache = RenderCache()
+        self.delivery = SlackDelivery(self.backend, sc, self.log)
+        #the ads claimed but not queued before a crash are pending again
+        self.backend.recover_deliveries()
         self._start_bg()
         
+    def _load_config(self, filename):
+        """this function loads the settings of the backend from a JSON file
+        (SELOGER_CONFIG, or SELOGER_EXCLUSIONS, its former name): the rules
+        excluding ads, their retention, the archive and the market window:
+        {"max_age": 30, "exclusions": [{"field": "descriptif", "contains": ["viager"]}],
+         "retention": {"1": 90, "2": 180}, "archive": "archive.seloger",
+         "market_window": 90}
+        (all the keys are optional)
+        """
+        if not filename:
+            return {}
+        with open(filename) as f:
+            config = json.load(f)
+        return dict((key, config[key])
+                for key in ('exclusions', 'max_age', 'retention', 'archive', 'market_window')
+                if key in config)
+
     def _send_msg(self, msg, to, private):
         self.sc.api_call(
             'chat.postMessage',
@@ -464,10 +3129,15 @@ class SeLoger():
             'slhelp': [None, 'Help for this module'],
             'sladdrent': ['<postal code> <min surface> <max price> <min_num_room>', 'Register  a new rent search'],
             'sladdbuy': ['<postal code> <min surface> <max price> <min_num_room>', 'Register a new buy search'],
+            'sladdgeorent': ['<lat,lon,km|lat,lon;lat,lon;...> <postal codes> <min surface> <max price> <min_num_room>', 'Register a new rent search inside a circle or a polygon'],
+            'sladdgeobuy': ['<lat,lon,km|lat,lon;lat,lon;...> <postal codes> <min surface> <max price> <min_num_room>', 'Register a new buy search inside a circle or a polygon'],
             'sllist': [None, 'List your active searches:'],
             'sldisable': ['<search ID>', 'Remove the given search (use sllist to get <search ID>)'],
             'slstatrent': ['<postal code|\'all\'>', 'Print some stats about \'rent\' searches'],
             'slstatbuy': ['<postal code|\'all\'>', 'Print some stats about \'buy\'  searches'],
+            'slpricerent': ['<postal code|\'all\'> <days>', 'Print the prices of all the \'rent\' ads of the last days'],
+            'slpricebuy': ['<postal code|\'all\'> <days>', 'Print the prices of all the \'buy\' ads of the last days'],
+            'slcheckstats': [None, 'Check the stats against the ads (and repair them)'],
         }
         msg = 'Action I can provide:\n'
         for cmd in help_content:
@@ -516,6 +3186,42 @@ event):
             as_user=False
         )
 
+    def sladdgeorent(self, area: Area, pcs: _postal_codes, min_surf: int, max_price: int,
+            nb_pieces: int, event):
+        """usage: sladdgeorent <lat,lon,km|lat,lon;lat,lon;lat,lon...> <postal codes> <min surface> <max price> <nb_pieces>
+        Adds a new rent search inside a circle or a polygon,
+        the postal codes (comma separated) must cover the area
+        """
+        user = event['user']
+        self._addSearch(str(user), pcs, str(min_surf), str(max_price), '1',
+                str(nb_pieces), area)
+        msg='Done sladd'
+        self.sc.api_call(
+            'chat.postMessage',
+            channel=event['channel'],
+            text=msg,
+            username='selogerbot',
+            as_user=False
+        )
+
+    def sladdgeobuy(self, area: Area, pcs: _postal_codes, min_surf: int, max_price: int,
+            nb_pieces: int, event):
+        """usage: sladdgeobuy <lat,lon,km|lat,lon;lat,lon;lat,lon...> <postal codes> <min surface> <max price> <nb_pieces>
+        Adds a new buy search inside a circle or a polygon,
+        the postal codes (comma separated) must cover the area
+        """
+        user = event['user']
+        self._addSearch(str(user), pcs, str(min_surf), str(max_price), '2',
+                str(nb_pieces), area)
+        msg='Done sladd'
+        self.sc.api_call(
+            'chat.postMessage',
+            channel=event['channel'],
+            text=msg,
+            username='selogerbot',
+            as_user=False
+        )
+
     def sldisable(self, id_search: str, event):
         """usage: sldisable <id_search>
         Disables a search
@@ -552,8 +3258,7 @@ event):
         Specify 'all' (no filter), or a specific postal code
         """
         user = event['user']
-        self._gen_stat_rooms(user, pc, '1')
-        self._gen_stat_surface(user, pc, '1')
+        self._gen_stats(user, pc, '1')
         msg='Done slstatrent'
         self._send_msg(msg,to=user,private=True)
 
@@ -563,255 +3268,252 @@ event):
         Specify 'all' (no filter), or a specific postal code
         """
         user = event['user']
-        self._gen_stat_rooms(user, pc, '2')
-        self._gen_stat_surface(user, pc, '2')
+        self._gen_stats(user, pc, '2')
         msg='Done slstatbuy'
         self._send_msg(msg,to=user,private=True)
 
+    def slpricerent(self, pc: str, days: int, event):
+        """usage: slpricerent <postal code|'all'> <days>
+        give you the prices (median, p10, p90, per square meter, by week)
+        of all the rent ads of a postal code of the last days
+        """
+        user = event['user']
+        self._gen_stat_prices(user, pc, '1', days)
+        msg='Done slpricerent'
+        self._send_msg(msg,to=user,private=True)
+
+    def slpricebuy(self, pc: str, days: int, event):
+        """usage: slpricebuy <postal code|'all'> <days>
+        give you the prices (median, p10, p90, per square meter, by week)
+        of all the buy ads of a postal code of the last days
+        """
+        user = event['user']
+        self._gen_stat_prices(user, pc, '2', days)
+        msg='Done slpricebuy'
+        self._send_msg(msg,to=user,private=True)
+
+    def slcheckstats(self, event):
+        """usage: slcheckstats
+        check that the stats match the ads, and repair them if they don't
+        """
+        errors = self.backend.check_stats(repair=True)
+        if errors:
+            msg = 'Done slcheckstats: %d stats out of sync, repaired' % len(errors)
+        else:
+            msg = 'Done slcheckstats: stats in sync'
+        self.sc.api_call(
+            'chat.postMessage',
+            channel=event['channel'],
+            text=msg,
+            username='selogerbot',
+            as_user=False
+        )
+
     ### The internal methods
     def _print_stats(self, user, stats):
         """ small function to print a list of line in different color
         """
+        self._send_msg(self._format_stats(stats),to=user,private=True)
 
+    def _format_stats(self, stats):
+        """ small function formatting a list of line as a message
+        """
         #empty line for lisibility
-        msg = '```'
-
-        #list of colors we use (order matters)
-        colors = [ 15, 14, 10, 3, 7, 2, 6, 5 ]  
-        colors_len = len(colors)
-        color = 0
+        return '```\n' + '\n'.join(stats) + '```'
 
-        for line in stats:
-            msg += '\n' + line
-        msg += '```'
-        self._send_msg(msg,to=user,private=True)
+    def _gen_stats(self, user, pc, ad_type):
+        """internal function sending the stats about the rooms and the surface,
+        they are rendered again only when they changed since the last time
+        """
+        #the version is read before the stats: if they change in between,
+        #the render is only done again next time
+        key = (user, ad_type, pc, self.backend.get_stats_version(user, pc, ad_type))
+        msgs = self.render_cache.get(key)
+        if msgs is None:
+            msgs = self._gen_stat_rooms(user, pc, ad_type) + \
+                    self._gen_stat_surface(user, pc, ad_type)
+            self.render_cache.put(key, msgs)
+        for msg in msgs:
+            self._send_msg(msg,to=user,private=True)
 
 
     def _gen_stat_rooms(self, user, pc, ad_type):
-        """internal function generating stats about the number of rooms
+        """internal function generating stats about the number of rooms,
+        returns the messages to send
         """
-        #we get all the ads of the user (with a filter on the postal code)
-        ads = self.backend.get_all(user, pc, ad_type)
+        #we get the stats of the ads of the user (with a filter on the postal code)
+        stats = self.backend.get_stats_rooms(user, pc, ad_type)
 
         #if we have nothing to make stats on
-        if len(ads) == 0:
-            msg = 'no stats about number of rooms available'
-            self._send_msg(msg,to=user,private=True)
-            return
-
-        number_ads_by_room = {}
-        surface_by_room = {}
-        price_by_room = {}
-        surface_by_room = {}
+        if len(stats) == 0:
+            return ['no stats about number of rooms available']
 
         list_surface = []
         list_price = []
         list_number = []
 
-        for ad in ads:
-            rooms = ad['nbPiece']
-            #we increment 'n (rooms)' 
-            if rooms in number_ads_by_room:
-                number_ads_by_room[rooms] += 1
-            else:
-                number_ads_by_room[rooms] = 1
-
-            #we add the price to the corresponding field
-            if rooms in price_by_room:
-                price_by_room[rooms] += float(ad['prix'])
-            else:
-                price_by_room[rooms] = float(ad['prix'])
-
-            #we add the surface to the corresponding field
-            if rooms in surface_by_room:
-                surface_by_room[rooms] += float(ad['surface'])
-            else:
-                surface_by_room[rooms] = float(ad['surface'])
-    
         #we generate the list of tuples
-        for rooms in sorted(surface_by_room, key=int):
+        for rooms, number, surface, price in stats:
+            label = str(rooms) + ' room(s)'
 
             #the list for number of ads by number of rooms
-            list_number.append(( rooms  + ' room(s)',
-                number_ads_by_room[rooms]))
-
-            #calcul of the avrage surface for this number of rooms
-            surface_by_room[rooms] = surface_by_room[rooms] \
-                    / number_ads_by_room[rooms]
-
-            list_surface.append(( rooms  + ' room(s)', 
-                int(surface_by_room[rooms]))) 
+            list_number.append((label, number))
 
+            #the avrage surface for this number of rooms
+            list_surface.append((label, int(surface)))
 
-            #calcul of the avrage price for this number of rooms
-            price_by_room[rooms] = price_by_room[rooms] \
-                / number_ads_by_room[rooms] 
-
-            list_price.append(( rooms  + ' room(s)', 
-                int(price_by_room[rooms])))
+            #the avrage price for this number of rooms
+            list_price.append((label, int(price)))
 
         #we print all that
         graph_number = self.graph.graph(u'number of ads by room', list_number)
-        self._print_stats(user, graph_number)
-
         graph_surface =  self.graph.graph(u'surface by room', list_surface)
-        self._print_stats(user, graph_surface)
-
         graph_price = self.graph.graph(u'price by room', list_price)
-        self._print_stats(user, graph_price)
+        return [self._format_stats(graph) for graph in
+                (graph_number, graph_surface, graph_price)]
 
-    def _get_step(self, ads, id_row, number_of_steps):
-        """internal function generating a step for numerical range
+    def _gen_stat_prices(self, user, pc, ad_type, days):
+        """internal function generating the stats about the prices of all the ads
         """
-        mini = float(ads[0][id_row])
-        maxi = float(ads[0][id_row])
-
-        for ad in ads:
-            value = float(ad[id_row]) 
-            if value > maxi:
-                maxi = value
-            if value < mini:
-                mini = value
-        return max(1, int((maxi - mini) / number_of_steps))
+        columns = self.backend.get_market_columns(pc, ad_type, days)
+        stats = self.stats_engine.compute(columns)
 
-    def _gen_stat_surface(self, user, pc, ad_type):
-        """internal function generating stats about the surface
-        """
-        #we get all the ads of the user (with a filter on the postal code)
-        ads = self.backend.get_all(user, pc, ad_type)
         #if we have nothing to make stats on
-        if len(ads) == 0:
-            msg = 'no stats about surface available'
+        if stats['price'] is None:
+            msg = 'no ads in %s in the last %d days' % (pc, days)
             self._send_msg(msg,to=user,private=True)
             return
 
-        number_ads_by_range = {}
-        rent_by_range = {}
-        price_by_range = {}
+        lines = ['%d ads in %s in the last %d days' % (stats['count'], pc, days)]
+        for label, key in (('price', 'price'), ('price per square meter', 'price_m2')):
+            if stats[key] is not None:
+                number, mean, p10, median, p90 = stats[key]
+                lines.append('%s: median %d (p10 %d, p90 %d), mean %d' % (label,
+                    median, p10, p90, mean))
+        self._print_stats(user, lines)
+
+        #the median price per square meter by rooms, surface range and week
+        list_rooms = [('%d room(s) (%d ads)' % (rooms, stat[0]), int(stat[3]))
+                for rooms, stat in stats['rooms']]
+        step = self.stats_engine.surface_step
+        last = self.stats_engine.surface_max // step
+        list_surface = [(('%d to %d' % (surface * step, (surface + 1) * step) if surface < last
+                else '%d+' % (surface * step)) + ' (%d ads)' % stat[0], int(stat[3]))
+                for surface, stat in stats['surface']]
+        list_weeks = [('%d-W%02d (%d ads)' % (datetime.date.fromtimestamp(week * 604800 - 259200)
+                .isocalendar()[:2] + (stat[0], )), int(stat[3])) for week, stat in stats['weeks']]
+        for title, data in (('median price per square meter by room', list_rooms),
+                ('median price per square meter by surface range', list_surface),
+                ('median price per square meter by week', list_weeks)):
+            if data:
+                self._print_stats(user, self.graph.graph(title, data))
 
+    def _gen_stat_surface(self, user, pc, ad_type):
+        """internal function generating stats about the surface,
+        returns the messages to send
+        """
+        #we get the stats of the ads of the user (with a filter on the postal code)
+        #the step of the range is at most 5
+        step, stats = self.backend.get_stats_surface(user, pc, ad_type, 7, 5)
+        #if we have nothing to make stats on
+        if len(stats) == 0:
+            return ['no stats about surface available']
 
         list_rent = []
         list_price = []
         list_number = []
 
-        number_of_steps = 7
-        #we calcul the step of the range (max step is 5)
-        step = min(self._get_step(ads, 'surface', number_of_steps), 5)
-
-        for ad in ads:
-            surface_range = str(int(float(ad['surface']) / step))
-
-            #we count the number of ads by range
-            if surface_range in number_ads_by_range:
-                number_ads_by_range[surface_range] += 1
-            else:
-                number_ads_by_range[surface_range] = 1
-
-            #we add the rent to the corresponding range
-            if surface_range in rent_by_range:
-                rent_by_range[surface_range] += float(ad['prix'])
-            else:
-                rent_by_range[surface_range] = float(ad['prix'])
-    
-            #we add the rent per square meter to the corresponding range
-            if surface_range in price_by_range:
-                price_by_range[surface_range] += float(ad['prix']) \
-                        / float(ad['surface'])
-            else:
-                price_by_range[surface_range] = float(ad['prix']) \
-                        / float(ad['surface'])
- 
         #we generate the list of tuples to print
-        for surface_range in sorted(number_ads_by_range, key=int):
+        for surface_range, number, rent, price in stats:
             #calcul of the label
-            label = str( int(surface_range) * step) + \
+            label = str(surface_range * step) + \
                     ' to ' +\
-                    str((int(surface_range) + 1) * step)
+                    str((surface_range + 1) * step)
 
             #number of ads by range
-            list_number.append(( label,
-                number_ads_by_range[surface_range]))
-
-            #calcul of mid rent by range
-            mid_rent = int(rent_by_range[surface_range] \
-                    / number_ads_by_range[surface_range])
-
-            list_rent.append(( label,
-                mid_rent))
+            list_number.append((label, number))
 
-            #calcul of mid rent per square meter by range
-            mid_price = int(price_by_range[surface_range] \
-                    / number_ads_by_range[surface_range])
+            #mid rent by range
+            list_rent.append((label, int(rent)))
 
-            list_price.append(( label,
-                mid_price))
+            #mid rent per square meter by range
+            list_price.append((label, int(price)))
 
         #we print all these stats
         graph_number = self.graph.graph(u'number of ads by surface range', list_number)
-        self._print_stats(user, graph_number)
-
         graph_rent =  self.graph.graph(u'price by surface range', list_rent)
-        self._print_stats(user, graph_rent)
-
         graph_price = self.graph.graph(u'price per square meter by surface range', list_price)
-        self._print_stats(user, graph_price)
+        return [self._format_stats(graph) for graph in
+                (graph_number, graph_rent, graph_price)]
  
  
     def _start_bg(self):
         """black supybot magic... at least for me
         """
-        t = threading.Thread(None,self._print_loop, None,)
-        t.start()
+        self.scheduler = Scheduler(self.log)
+        #we look for the searches due for a poll every minute
+        #(each search has its own polling interval)
+        self.scheduler.add('ingest', self._update_db, 60, jitter=10, max_runtime=1200)
+        #the new ads are queued as soon as a search is done
+        #(and at least every minute)
+        self.scheduler.add('notify', self._notify, 60, max_runtime=120)
+        self.scheduler.add('deliver', self.delivery.deliver, 5, max_runtime=600)
+        self.scheduler.add('stats', self._refresh_stats, 86400, jitter=3600,
+                max_runtime=3600, delay=3600)
+        self.scheduler.add('retention', self.backend.prune, 86400, jitter=3600,
+                max_runtime=3600, delay=7200)
+        self.scheduler.start()
         print("starting")
 
     def _update_db(self):
         """direct call to do_search from the backend class
         it gets the new ads from SeLoger
         """
-        self.backend.do_searches()
+        print('Get new ads')
+        self.backend.do_searches(on_query_done=self._query_done)
 
-    def _acquireLock(self, url, blocking=True):
-        """Lock handler for the threads
+    def _query_done(self, query):
+        """called when all the pages of a search are stored,
+        the new ads are sent without waiting for the other searches
         """
-        try:
-            self.gettingLockLock.acquire()
-            try:
-                lock = self.locks[url]
-            except KeyError:
-                lock = threading.RLock()
-                self.locks[url] = lock
-            return lock.acquire(blocking=blocking)
-        finally:
-            self.gettingLockLock.release()
+        self.scheduler.trigger('notify')
 
-    def _releaseLock(self, url):
-        """Lock handler for the threads
+    def _notify(self):
+        """This function queues the new results for each user
         """
-        self.locks[url].release()
+        ads = self.backend.get_new()
+        if not ads:
+            return
+        print('Start printing')
+        #the ads are queued, the delivery job sends them
+        total = len(ads)
+        messages = []
+        failed = set()
+        counter = 1
+        for ad in ads:
+            #an ad we can't format doesn't hold back the others
+            try:
+                messages.append(self._print_ad(ad, counter, total))
+            except Exception:
+                self.log.exception('failed to format ad %s', ad['idAnnonce'])
+                failed.add(ad['uniq_id'])
+            counter += 1
+        #the claimed ads are given back if they can't be queued
+        try:
+            self.backend.enqueue_messages(messages)
+        except Exception:
+            self.backend.release_deliveries([ad['uniq_id'] for ad in ads
+                if ad['uniq_id'] not in failed])
+            raise
+        finally:
+            self.backend.fail_deliveries(failed)
+        self.scheduler.trigger('deliver')
+        print('End printing')
 
-    def _print_loop(self):
-        """This function updates the database 
-        and prints any new results to each user
+    def _refresh_stats(self):
+        """This function checks (and repairs) the stats
         """
-        while True:
-            try:
-                if self._acquireLock('print', blocking=False):
-                    print('Get new ads')
-                    self._update_db()
-                    print('Call seloger for new ads')
-                    ads = self.backend.get_new()
-                    print('Start printing')
-                    total = len(ads)
-                    counter = 1
-                    for ad in ads:
-                        self._print_ad(ad, counter, total)
-                        counter += 1
-                    print('End printing')
-                    #we search every 5 minutes
-                    time.sleep(300)
-                    self._releaseLock('print')
-            except Exception as e:
-                print(str(e))
+        self.backend.check_stats(repair=True)
 
     def _reformat_date(self, date):
         """small function reformatting the date from SeLoger
@@ -820,7 +3522,8 @@ event):
         return  d.strftime('%d/%m/%Y %H:%M')
 
     def _print_ad(self,ad, counter, total):
-        """this function prints one ad
+        """this function formats one ad, it returns the message
+        to queue as (user, text, uniq ids of the ads)
         """
         #user needs to be an ascii string, not unicode
         user = str(ad['owner_id'])
@@ -862,18 +3565,18 @@ event):
 
         #printing the permanent link of the ad
         msg += '\n' + 'Lien: ' + ad['permaLien']
-        self._send_msg(msg,to=user,private=True)
 
         #one more time, an empty line for lisibility
         #msg =  ' '
         #self._send_msg(msg,to=user,private=True)
 
         self.log.debug('printing ad %s of %s ', ad['idAnnonce'], user)
+        return user, msg, [ad['uniq_id']]
  
-    def _addSearch(self, user, pc, min_surf, max_price, ad_type, nb_pieces):
+    def _addSearch(self, user, pc, min_surf, max_price, ad_type, nb_pieces, area=None):
         """this function adds a search"""
         self.backend.add_search(user, pc, min_surf, max_price, ad_type,
-                nb_pieces)
+                nb_pieces, area)
 
     def _disableSearch(self, user, id_search):
         """this function disables a search"""
@@ -888,6 +3591,8 @@ event):
             surface = "Surface >= " + search['min_surf']
             loyer = "Loyer/Prix <= " + search['max_price']
             cp = "Code Postal == " + search['cp']
+            if search.get('geo'):
+                cp = "Codes Postaux == " + search['cps'] + " | Zone == " + search['geo']
             if search['ad_type'] == '2':
                 ad_type = '2 (achat)'
             elif search['ad_type'] == '1':
@@ -1043,7 +3748,7 @@ class Pyasciigraph:
             totalvalue_len = 0
 
             # If we have a list of values for the item
-            if isinstance(value, collections.Iterable):
+            if isinstance(value, collections.abc.Iterable):
                 icount = 0
                 maxvalue = 0
                 minvalue = 0
@@ -1117,10 +3822,12 @@ class Pyasciigraph:
             neg_width = int(abs(float(min_neg_value)) * float(graph_length) / float(all_width))
             pos_width = int(abs(max_value) * graph_length / all_width)
 
-        if isinstance(value, collections.Iterable):
+        if isinstance(value, collections.abc.Iterable):
             accuvalue = 0
-            totalstring = ""
             totalsquares = 0
+            #the parts of the bar, joined at the end
+            neg_parts = []
+            pos_parts = []
 
             sortedvalue = copy.deepcopy(value)
             sortedvalue.sort(reverse=False, key=lambda tup: tup[0])
@@ -1134,12 +3841,13 @@ class Pyasciigraph:
                 scaled_value = ivalue - accuvalue
                 (partstr, squares) = _gen_graph_string_part(
                     scaled_value, max_value, min_neg_value, graph_length, icolor)
-                totalstring = partstr + totalstring
+                neg_parts.append(partstr)
                 totalsquares += squares
                 accuvalue += scaled_value
 
             # left padding
-            totalstring = Pyasciigraph._u(' ') * (neg_width - abs(totalsquares)) + totalstring
+            neg_parts.append(Pyasciigraph._u(' ') * (neg_width - abs(totalsquares)))
+            neg_parts.reverse()
 
             # reset some counters
             accuvalue = 0
@@ -1152,25 +3860,25 @@ class Pyasciigraph:
                 scaled_value = ivalue - accuvalue
                 (partstr, squares) = _gen_graph_string_part(
                     scaled_value, max_value, min_neg_value, graph_length, icolor)
-                totalstring += partstr
+                pos_parts.append(partstr)
                 totalsquares += squares
                 accuvalue += scaled_value
 
             # right padding
-            totalstring += Pyasciigraph._u(' ') * (start_value_pos - neg_width - abs(totalsquares))
-            return totalstring
+            pos_parts.append(Pyasciigraph._u(' ') * (start_value_pos - neg_width - abs(totalsquares)))
+            return ''.join(neg_parts) + ''.join(pos_parts)
         else:
             # handling for single value item
             (partstr, squares) = _gen_graph_string_part(
                 value, max_value, min_neg_value, graph_length, color)
             if value >= 0:
-                return Pyasciigraph._u(' ') * neg_width + \
-                        partstr + \
-                        Pyasciigraph._u(' ') * (start_value_pos - (neg_width + squares))
+                return ''.join((Pyasciigraph._u(' ') * neg_width,
+                        partstr,
+                        Pyasciigraph._u(' ') * (start_value_pos - (neg_width + squares))))
             else:
-                return Pyasciigraph._u(' ') * (neg_width - squares) +\
-                        partstr +\
-                        Pyasciigraph._u(' ') * (start_value_pos - neg_width)
+                return ''.join((Pyasciigraph._u(' ') * (neg_width - squares),
+                        partstr,
+                        Pyasciigraph._u(' ') * (start_value_pos - neg_width)))
 
 
     def _gen_info_string(self, info, start_info_pos, line_length):
@@ -1182,24 +3890,15 @@ class Pyasciigraph:
     def _gen_value_string(self, value, min_neg_value, color, start_value_pos, start_info_pos):
         """Generate the value string + padding
         """
-        icount = 0
-        if isinstance(value, collections.Iterable) and self.multivalue:
-            for (ivalue, icolor) in value:
-                if icount == 0:
-                    # total_len is needed because the color characters count
-                    # with the len() function even when they are not printed to
-                    # the screen.
-                    totalvalue_len = len(self._trans_hr(ivalue))
-                    totalvalue = Pyasciigraph._color_string(
-                        self._trans_hr(ivalue), icolor)
-                else:
-                    totalvalue_len += len("," + self._trans_hr(ivalue))
-                    totalvalue += "," + \
-                        Pyasciigraph._color_string(
-                            self._trans_hr(ivalue),
-                            icolor)
-                icount += 1
-        elif isinstance(value, collections.Iterable):
+        if isinstance(value, collections.abc.Iterable) and self.multivalue:
+            values = [self._trans_hr(ivalue) for (ivalue, icolor) in value]
+            # total_len is needed because the color characters count
+            # with the len() function even when they are not printed to
+            # the screen.
+            totalvalue_len = len(",".join(values))
+            totalvalue = ",".join(Pyasciigraph._color_string(ivalue, icolor)
+                    for ivalue, (_, icolor) in zip(values, value))
+        elif isinstance(value, collections.abc.Iterable):
             max_value = min_neg_value
             color = None
             for (ivalue, icolor) in value:
@@ -1225,10 +3924,9 @@ class Pyasciigraph:
         if number_space < 0:
             number_space = 0
 
-        return  ' ' * number_space + totalvalue +\
-                ' ' * \
-            ((start_info_pos - start_value_pos - totalvalue_len)
-             - number_space)
+        return ''.join((' ' * number_space, totalvalue,
+                ' ' * ((start_info_pos - start_value_pos - totalvalue_len)
+                       - number_space)))
 
     def _sanitize_string(self, string):
         """try to convert strings to UTF-8
@@ -1253,7 +3951,7 @@ class Pyasciigraph:
     def _sanitize_value(self, value):
         """try to values to UTF-8
         """
-        if isinstance(value, collections.Iterable):
+        if isinstance(value, collections.abc.Iterable):
             newcollection = []
             for i in value:
                 if len(i) == 1:
@@ -1268,7 +3966,7 @@ class Pyasciigraph:
         ret = []
         for item in data:
             if (len(item) == 2):
-                if isinstance(item[1], collections.Iterable):
+                if isinstance(item[1], collections.abc.Iterable):
                     ret.append(
                         (self._sanitize_string(item[0]),
                          self._sanitize_value(item[1]),
@@ -1365,27 +4063,13 @@ class Pyasciigraph:
                     start_info_pos,
                     real_line_length
             )
-            new_line = graph_string + value_string + info_string
-            result.append(new_line)
+            result.append(''.join((graph_string, value_string, info_string)))
 
         return result
 
 
 from pprint import pprint
 
-# Here we scan methods of the class to recover the public ones
-# every public method is a slack command
-def _scan_methods(obj, cmd_prefix='!'):
-    methods = inspect.getmembers(obj, predicate=inspect.ismethod)
-    ret = []
-    for m in methods:
-        if not re.match(r'^_', m[0]):
-            method = getattr(obj, m[0])
-            sig = inspect.signature(method)
-            ret.append((r"^%s%s " % (cmd_prefix, m[0]), method, sig))
-            ret.append((r"^%s%s$" % (cmd_prefix, m[0]), method, sig))
-    return ret
-
 class WrongNumberOfArgs(Exception):
     pass
 
@@ -1393,97 +4077,529 @@ class WrongNumberOfArgs(Exception):
 class WrongTypeOfArg(Exception):
     pass
 
-# parse the command arguments compare with the method and cast with the type declare
-def _parse_cmd(cmd, sig):
-    args = re.split('\W+', cmd)[2:]
-    ret = {}
-    c = 0
-    if len(args) != (len(sig.parameters) - 1):
-        raise WrongNumberOfArgs()
-    for arg in sig.parameters:
-        if arg != 'event':
+
+# every public method of the object is a slack command
+class CommandRouter(object):
+    """This Class finds the command of a message: it's built once from
+    the public methods of an object, the command is found by a lookup
+    on the first word of the message, and the arguments are converted
+    with the annotations of the method.
+    A command can also be called with an alias, or as a subcommand
+    of a group ("!sl addrent ..." is "!sladdrent ...").
+    """
+
+    def __init__(self, obj, cmd_prefix='!', aliases=None, groups=('sl', )):
+        self.cmd_prefix = cmd_prefix
+        #the commands by name
+        self.commands = {}
+        for name, method in inspect.getmembers(obj, predicate=inspect.ismethod):
+            if name.startswith('_'):
+                continue
+            sig = inspect.signature(method)
+            #the name and the conversion of each argument (except event)
+            converters = tuple((arg.name, arg.annotation)
+                    for arg in sig.parameters.values() if arg.name != 'event')
+            self.commands[name] = {
+                'name': name,
+                'method': method,
+                'converters': converters,
+                }
+        #other names of the commands
+        for alias, name in (aliases or {}).items():
+            self.commands[alias] = self.commands[name]
+        self.groups = frozenset(groups)
+
+    def find(self, text):
+        """returns the command called by a message (None if it's not a command)
+        arg 1: the text of the message
+        """
+        if not text.startswith(self.cmd_prefix):
+            return None
+        words = text[len(self.cmd_prefix):].split(None, 2)
+        if not words:
+            return None
+        name = words[0].lower()
+        command = self.commands.get(name)
+        if command is None and name in self.groups and len(words) > 1:
+            command = self.commands.get(name + words[1].lower())
+        return command
+
+    def parse(self, command, text):
+        """returns the arguments of a command (dictionnary), converted
+        with the annotations of the method
+        arg 1: the command (returned by find)
+        arg 2: the text of the message
+        """
+        words = text[len(self.cmd_prefix):].split(None, 1)
+        rest = words[1] if len(words) > 1 else ''
+        #the name of the subcommand is not an argument
+        if words[0].lower() in self.groups and words[0].lower() != command['name']:
+            words = rest.split(None, 1)
+            rest = words[1] if len(words) > 1 else ''
+        args = rest.split()
+        converters = command['converters']
+        if len(args) != len(converters):
+            raise WrongNumberOfArgs()
+        ret = {}
+        for (name, converter), arg in zip(converters, args):
             try:
-                ret[arg] = sig.parameters[arg].annotation(args[c])
+                ret[name] = converter(arg)
             except ValueError:
-                raise WrongTypeOfArg("wrong type for arg '%s'" % arg)
-            c += 1
-    return ret
+                raise WrongTypeOfArg("wrong type for arg '%s'" % name)
+        return ret
+
+class Scheduler(object):
+    """This Class runs periodic jobs, each job in its own thread,
+    so a job never overlaps with itself (a job triggered while it's
+    running runs once more right after), and a slow job never delays
+    the others. A watchdog warns about the jobs running for too long.
+    """
+
+    def __init__(self, log, watchdog_interval=10):
+        self.log = log
+        self.jobs = collections.OrderedDict()
+        #the time (in seconds) between two checks of the watchdog
+        self.watchdog_interval = watchdog_interval
+
+    def add(self, name, func, interval, jitter=0, max_runtime=None, delay=0):
+        """adds a job
+        arg 1: the name of the job
+        arg 2: the function run by the job
+        arg 3: the time (in seconds) between the end of a run and the next one
+        arg 4: a random time (at most jitter seconds) added to the interval
+        arg 5: the time (in seconds) after which a run is reported as too long
+        arg 6: the time (in seconds) before the first run
+        """
+        self.jobs[name] = {
+            'name': name,
+            'func': func,
+            'interval': interval,
+            'jitter': jitter,
+            'max_runtime': max_runtime,
+            'delay': delay,
+            'event': threading.Event(),
+            'started': None,
+            'reported': False,
+            }
+
+    def trigger(self, name):
+        """runs a job as soon as possible
+        arg 1: the name of the job
+        """
+        self.jobs[name]['event'].set()
+
+    def start(self):
+        """starts the threads of the jobs and of the watchdog
+        """
+        for job in self.jobs.values():
+            t = threading.Thread(None, self._run_job, 'job-' + job['name'], (job, ))
+            t.daemon = True
+            t.start()
+        t = threading.Thread(None, self._watchdog, 'watchdog')
+        t.daemon = True
+        t.start()
+
+    def _run_job(self, job):
+        next_run = time.time() + job['delay']
+        while True:
+            job['event'].wait(max(0, next_run - time.time()))
+            job['event'].clear()
+            job['started'] = time.time()
+            try:
+                job['func']()
+            except Exception as e:
+                self.log.exception('job %s failed: %s', job['name'], e)
+            finally:
+                job['started'] = None
+                job['reported'] = False
+            next_run = time.time() + job['interval'] + random.uniform(0, job['jitter'])
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.watchdog_interval)
+            now = time.time()
+            for job in self.jobs.values():
+                started = job['started']
+                if started is None or job['max_runtime'] is None or job['reported']:
+                    continue
+                if now - started > job['max_runtime']:
+                    job['reported'] = True
+                    self.log.warning('job %s is running for %ds (max %ds)',
+                            job['name'], now - started, job['max_runtime'])
+
+
+class TokenBucket(object):
+    """Token bucket limiting the rate of the calls to an API
+    """
+
+    def __init__(self, rate, capacity):
+        #the number of tokens added each second, and the maximum
+        #number of tokens (the size of a burst)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.time()
+        #no call before this date (set by a Retry-After)
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return now
+
+    def reserve(self):
+        """takes a token, returns the time to wait before using it
+        """
+        now = self._refill()
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        """takes a token if one is available now, returns True if it was taken
+        """
+        now = self._refill()
+        if self.tokens < 1 or self.blocked_until > now:
+            return False
+        self.tokens -= 1
+        return True
+
+    def block(self, delay):
+        """no call for the given delay (in seconds)
+        """
+        self.blocked_until = max(self.blocked_until, time.time() + delay)
+
 
 # small wrapper to add a wraper in order to avoid API saturation
+# (a token bucket per API method and per channel, honoring Retry-After)
 class SlackClientWrapper(SlackClient):
 
-    def __init__(*args, **kargs):
-        self.lastapicall = 0 
+    def __init__(self, *args, **kargs):
+        #rate (calls per second) and burst of each API method
+        self.method_rates = kargs.pop('method_rates', {'chat.postMessage': (1, 5)})
+        self.default_rate = kargs.pop('default_rate', (1, 5))
+        #rate (messages per second) and burst for each channel
+        self.channel_rate = kargs.pop('channel_rate', (1, 3))
+        #number of retries when slack answers "ratelimited"
+        self.max_retries = kargs.pop('max_retries', 3)
+        self.buckets = {}
         self.lock = threading.Lock()
         super().__init__(*args, **kargs)
-    
-    def api_call(*args, **kargs):
-        self.lock.acquire()
+
+    def _bucket(self, key, rate):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*rate)
+        return self.buckets[key]
+
+    def api_call(self, method, **kargs):
+        channel = kargs.get('channel')
+        for attempt in range(self.max_retries + 1):
+            with self.lock:
+                buckets = [self._bucket(('method', method),
+                    self.method_rates.get(method, self.default_rate))]
+                if channel is not None:
+                    buckets.append(self._bucket(('channel', channel), self.channel_rate))
+                wait = max(bucket.reserve() for bucket in buckets)
+            if wait > 0:
+                time.sleep(wait)
+            result = super().api_call(method, **kargs)
+            if result.get('ok') or result.get('error') != 'ratelimited':
+                return result
+            retry_after = int(result.get('headers', {}).get('Retry-After', 1))
+            with self.lock:
+                for bucket in buckets:
+                    bucket.block(retry_after)
+        return result
+
+
+class SlackDelivery(object):
+    """This Class sends the messages queued in the database to slack,
+    from its own job so the refresh of the ads never waits for slack.
+    When many messages are waiting for the same user, they are folded
+    in one message (one attachment by message).
+    """
+
+    def __init__(self, backend, sc, log, batch_threshold=3, batch_max=20,
+            max_delay=3600, max_attempts=10):
+        self.backend = backend
+        self.sc = sc
+        self.log = log
+        #from this number of messages waiting for a channel, they are
+        #sent together (at most batch_max by message)
+        self.batch_threshold = batch_threshold
+        self.batch_max = batch_max
+        #the maximum delay (in seconds) before retrying a message
+        self.max_delay = max_delay
+        #after max_attempts failures, a message is dropped and its ads
+        #are marked as failed (they are claimed again later, a few times)
+        self.max_attempts = max_attempts
+        #the errors retrying can't fix, the message is dropped at once
+        self.permanent_errors = frozenset((
+            'channel_not_found', 'is_archived', 'not_in_channel', 'invalid_auth',
+            'not_authed', 'account_inactive', 'token_revoked', 'user_not_found',
+            'msg_too_long', 'no_text', 'invalid_arguments', 'restricted_action',
+        ))
+
+    def deliver(self):
+        """sends all the messages which can be sent now
+        """
+        while self.run_once():
+            pass
+
+    def run_once(self):
+        """sends the messages which can be sent now,
+        returns True if some were sent
+        """
+        messages = self.backend.get_outbox()
+        if not messages:
+            return False
+
+        #we group the messages by channel (keeping their order)
+        by_channel = collections.OrderedDict()
+        for message in messages:
+            by_channel.setdefault(message[1], []).append(message)
+
+        sent = False
+        for channel, channel_messages in by_channel.items():
+            if len(channel_messages) < self.batch_threshold:
+                batches = [[message] for message in channel_messages]
+            else:
+                batches = [channel_messages[i:i + self.batch_max]
+                        for i in range(0, len(channel_messages), self.batch_max)]
+            for batch in batches:
+                sent = self._send(channel, batch) or sent
+        return sent
+
+    def _send(self, channel, batch):
+        """sends one message (or a batch of messages folded in one)
+        """
+        msg_ids = [message[0] for message in batch]
+        if len(batch) == 1:
+            args = {'text': batch[0][2]}
+        else:
+            args = {
+                'text': '%d new ads' % len(batch),
+                'attachments': json.dumps([{'text': message[2]} for message in batch]),
+            }
         try:
-            while int(datetime.datetime.now().strftime("%s")) - self.lastapicall < 2:
-                time.sleep(0.5)
-            super().api_call(*args, **kargs)
-            self.lastapicall = int(datetime.datetime.now().strftime("%s"))
+            result = self.sc.api_call(
+                'chat.postMessage',
+                channel=channel,
+                username='selogerbot',
+                as_user=False,
+                **args
+            )
         except Exception as e:
-            print(str(e))
-        finally:
-            self.lock.release()
+            result = {'ok': False, 'error': str(e)}
+
+        if result.get('ok'):
+            self.backend.ack_messages(msg_ids)
+            return True
+
+        attempts = max(message[3] for message in batch)
+        if attempts + 1 >= self.max_attempts or result.get('error') in self.permanent_errors:
+            self.log.warning('could not send %d message(s) to %s (%s), giving up',
+                    len(batch), channel, result.get('error'))
+            self.backend.fail_messages(msg_ids)
+            return False
+        delay = min(self.max_delay, 5 * 2 ** attempts)
+        if result.get('error') == 'ratelimited':
+            delay = max(delay, int(result.get('headers', {}).get('Retry-After', 1)))
+        self.log.warning('could not send %d message(s) to %s (%s), retry in %ds',
+                len(batch), channel, result.get('error'), delay)
+        self.backend.retry_messages(msg_ids, delay)
+        return False
+
+# runs a command (in a worker thread), the errors are reported in the channel
+def _run_cmd(slack_client, router, command, event):
+    channel = event['channel']
+    text = event['text']
+    try:
+        args = router.parse(command, text)
+        command['method'](**args, event=event)
+    except WrongTypeOfArg as e:
+        #print(e) 
+        msg = 'Wrong Number of arguments\n\n' + command['method'].__doc__
+        slack_client.api_call(
+            'chat.postMessage',
+            channel=channel,
+            text=str(e),
+            username='selogerbot',
+            as_user=False
+        )
+    except WrongNumberOfArgs as e:
+        #print(e) 
+        msg = 'Wrong Number of arguments\n\n' + command['method'].__doc__
+        slack_client.api_call(
+            'chat.postMessage',
+            channel=channel,
+            text=msg,
+            username='selogerbot',
+            as_user=False
+        )
+    except:
+        msg = 'Oups, I broke in an unexpected way'
+        slack_client.api_call(
+            'chat.postMessage',
+            channel=channel,
+            text=msg,
+            username='selogerbot',
+            as_user=False
+        )
 
-def main():
-    slack_token = os.environ["SLACK_API_TOKEN"]
-    slack_client = SlackClient(slack_token)
-    module = SeLoger(slack_client)
-    methods = _scan_methods(module)
 
-    if slack_client.rtm_connect():
+class CommandDispatcher(object):
+    """This Class reads the RTM events and runs the commands concurrently:
+    the events go through a bounded queue, each command runs in a pool
+    of worker threads (the handlers query the database and slack),
+    with a limit of commands running at the same time for each user,
+    so a heavy command never delays the commands of the others.
+    """
+
+    def __init__(self, slack_client, router, log, max_workers=8, per_user=1,
+            max_pending=5, queue_size=100, poll_interval=0.1, report_interval=300):
+        self.slack_client = slack_client
+        self.router = router
+        self.log = log
+        #the number of commands running at the same time
+        self.max_workers = max_workers
+        #the number of commands of one user running at the same time,
+        #and waiting (beyond, the commands are rejected)
+        self.per_user = per_user
+        self.max_pending = max_pending
+        #the size of the queue of events, when it's full we stop
+        #reading the events until a command is done
+        self.queue_size = queue_size
+        #the time (in seconds) between two reads when there is no event
+        self.poll_interval = poll_interval
+        #the time (in seconds) between two reports of the metrics
+        self.report_interval = report_interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        #the semaphore and the number of commands waiting or running
+        #for each user (only the users with commands in progress)
+        self.users = {}
+        self.metrics = {
+            'events': 0,
+            'commands': 0,
+            'rejected': 0,
+            'queue_max': 0,
+            'blocked': 0,
+            'blocked_time': 0.0,
+            }
+        #the latencies (in seconds) of the last commands
+        self.latencies = collections.deque(maxlen=1000)
+
+    def run(self):
+        """reads the events and runs the commands, forever
+        """
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        #the number of commands waiting or running
+        self.slots = asyncio.Semaphore(self.max_workers * self.max_pending)
+        asyncio.ensure_future(self._dispatch())
+        asyncio.ensure_future(self._report())
+        await self._read()
+
+    async def _read(self):
         while True:
-            events = slack_client.rtm_read()
+            #rtm_read doesn't block (the websocket is non-blocking)
+            events = self.slack_client.rtm_read()
             for event in events:
+                self.metrics['events'] += 1
                 if (
                     'channel' in event and
                     'text' in event and
                     'user' in event and
                     event.get('type') == 'message'
                 ):
-                    channel = event['channel']
-                    user = event['user']
-                    text = event['text']
-                    #pprint(event)
-                    for m in methods:
-                        if re.match(m[0], text.lower()):
-                            try:
-                                args = _parse_cmd(text, m[2])
-                                m[1](**args, event=event)
-                            except WrongTypeOfArg as e:
-                                #print(e) 
-                                msg = 'Wrong Number of arguments\n\n' + m[1].__doc__
-                                slack_client.api_call(
-                                    'chat.postMessage',
-                                    channel=channel,
-                                    text=str(e),
-                                    username='selogerbot',
-                                    as_user=False
-                                )
-                            except WrongNumberOfArgs as e:
-                                #print(e) 
-                                msg = 'Wrong Number of arguments\n\n' + m[1].__doc__
-                                slack_client.api_call(
-                                    'chat.postMessage',
-                                    channel=channel,
-                                    text=msg,
-                                    username='selogerbot',
-                                    as_user=False
-                                )
-                            except:
-                                msg = 'Oups, I broke in an unexpected way'
-                                slack_client.api_call(
-                                    'chat.postMessage',
-                                    channel=channel,
-                                    text=msg,
-                                    username='selogerbot',
-                                    as_user=False
-                                )
-            time.sleep(0.1)
+                    command = self.router.find(event['text'])
+                    if command is None:
+                        continue
+                    item = (time.time(), command, event)
+                    if self.queue.full():
+                        #backpressure: we stop reading until there is room
+                        self.metrics['blocked'] += 1
+                        start = time.time()
+                        await self.queue.put(item)
+                        self.metrics['blocked_time'] += time.time() - start
+                    else:
+                        self.queue.put_nowait(item)
+                    self.metrics['queue_max'] = max(self.metrics['queue_max'],
+                            self.queue.qsize())
+            if not events:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _dispatch(self):
+        while True:
+            received, command, event = await self.queue.get()
+            user = event['user']
+            if user not in self.users:
+                self.users[user] = [asyncio.Semaphore(self.per_user), 0]
+            if self.users[user][1] >= self.max_pending:
+                self.metrics['rejected'] += 1
+                asyncio.ensure_future(self._reject(event))
+                continue
+            self.users[user][1] += 1
+            await self.slots.acquire()
+            asyncio.ensure_future(self._run(received, command, event))
+
+    async def _run(self, received, command, event):
+        user = self.users[event['user']]
+        try:
+            async with user[0]:
+                await asyncio.get_running_loop().run_in_executor(
+                        self.executor, _run_cmd, self.slack_client, self.router,
+                        command, event)
+        finally:
+            user[1] -= 1
+            #the user's last command, the next one gets a new semaphore
+            if user[1] == 0:
+                del self.users[event['user']]
+            self.slots.release()
+            self.metrics['commands'] += 1
+            self.latencies.append(time.time() - received)
+
+    async def _reject(self, event):
+        msg = 'Too many commands in progress, please wait'
+        await asyncio.get_running_loop().run_in_executor(self.executor, lambda:
+            self.slack_client.api_call(
+                'chat.postMessage',
+                channel=event['channel'],
+                text=msg,
+                username='selogerbot',
+                as_user=False
+            ))
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            latencies = sorted(self.latencies)
+            if latencies:
+                p50 = latencies[len(latencies) // 2]
+                p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+            else:
+                p50 = p99 = 0
+            self.log.info('events %(events)d, commands %(commands)d, '
+                    'rejected %(rejected)d, queue max %(queue_max)d, '
+                    'blocked %(blocked)d (%(blocked_time).1fs)', self.metrics)
+            self.log.info('queue %d, latency p50 %.2fs, p99 %.2fs',
+                    self.queue.qsize(), p50, p99)
+
+
+def main():
+    slack_token = os.environ["SLACK_API_TOKEN"]
+    slack_client = SlackClientWrapper(slack_token)
+    module = SeLoger(slack_client)
+    router = CommandRouter(module, aliases={
+        'sladd_rent': 'sladdrent',
+        'sladd_buy': 'sladdbuy',
+        })
+
+    if slack_client.rtm_connect():
+        CommandDispatcher(slack_client, router, module.log).run()
     else:
         print('Connection failed, invalid token?')
 